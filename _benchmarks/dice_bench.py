@@ -0,0 +1,119 @@
+"""
+Microbenchmark of the dice engine.
+
+Times each stage of diceroll.parse_roll separately over a corpus of expressions: tokenization, conversion to reverse
+polish notation, compilation (uncached), evaluation with and without the dice log, and the full cached parse_roll.
+Reports calls per second and the peak memory traced during a call. Run from a Red Star install, so that red_star can
+be imported:
+
+    python _benchmarks/dice_bench.py --save before.json
+    (make changes)
+    python _benchmarks/dice_bench.py --compare before.json
+"""
+from argparse import ArgumentParser
+from pathlib import Path
+from timeit import Timer
+import json
+import sys
+import tracemalloc
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import diceroll
+
+corpus = {
+    "simple": ["1d20+5", "2d6", "d20", "3d8+2d6+4"],
+    "parenthesized": ["((((1d6+2)*3)-(2d4/(1+1)))+((3d8)))", "(" * 30 + "1d6" + "+1)" * 30],
+    "huge pools": ["100d10000", "10000d10000", "10000d6+10000d8"],
+    "advantage": ["d20a+7", "d20d", "10000d6a"],
+    "nested": ["2d6 d6", "1d100 d100", "3d6 d6 d6"],
+    "modifiers": ["4d6kh3", "10d10!kl2", "100d6r1dl10", "10000d20kh5"],
+    "multiple": ["4df 4df 4df", "1d20+5 1d20+5 2d6+3"],
+}
+
+
+def label(expression: str) -> str:
+    return expression if len(expression) <= 40 else expression[:37] + "..."
+
+
+def stages(expression: str) -> dict:
+    tokens = diceroll.roll_tokens.findall(expression.lower())
+    program = diceroll.compile_roll(expression)
+    return {
+        "tokenize": lambda: diceroll.roll_tokens.findall(expression.lower()),
+        "rpn": lambda: diceroll.to_rpn(tokens),
+        "compile": lambda: diceroll.compile_roll.__wrapped__(expression),
+        "evaluate": lambda: diceroll.run_program(program),
+        "evaluate (no log)": lambda: diceroll.run_program(program, log=False),
+        "parse_roll": lambda: diceroll.parse_roll(expression),
+    }
+
+
+def measure(func, duration: float, repeat: int) -> tuple:
+    """
+    :return: calls per second, best of repeat runs of about duration seconds, and the peak memory traced during one
+    call in bytes
+    """
+    timer = Timer(func)
+    number = 1
+    while timer.timeit(number) < duration / 4:
+        number *= 4
+    best = min(timer.repeat(repeat=repeat, number=number)) / number
+
+    tracemalloc.start()
+    func()  # warm up caches so that they don't count
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    func()
+    peak = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    return 1 / best, peak
+
+
+def run(args) -> dict:
+    if args.no_numpy:
+        diceroll.numpy = None
+    results = {}
+    for category, expressions in corpus.items():
+        for expression in expressions:
+            for stage, func in stages(expression).items():
+                results[f"{label(expression)} | {stage}"] = measure(func, args.duration, args.repeat)
+    return results
+
+
+def report(results: dict, baseline: dict = None):
+    name_width = max(len(name) for name in results)
+    header = f"{'expression | stage':<{name_width}}  {'calls/s':>12}  {'peak KiB':>9}"
+    if baseline:
+        header += f"  {'speedup':>8}"
+    print(header)
+    for category, expressions in corpus.items():
+        print(f"-- {category}")
+        for expression in expressions:
+            for stage in stages(expression):
+                name = f"{label(expression)} | {stage}"
+                rate, peak = results[name]
+                line = f"{name:<{name_width}}  {rate:>12,.0f}  {peak / 1024:>9.1f}"
+                if baseline and name in baseline:
+                    line += f"  {rate / baseline[name][0]:>7.2f}x"
+                print(line)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmark the stages of the dice engine.")
+    parser.add_argument("--no-numpy", action="store_true", help="benchmark the pure Python fallback")
+    parser.add_argument("--duration", type=float, default=0.05, help="approximate seconds per timing run")
+    parser.add_argument("--repeat", type=int, default=3, help="timing runs per stage, the best one counts")
+    parser.add_argument("--save", metavar="FILE", help="save the results as JSON, to compare against later")
+    parser.add_argument("--compare", metavar="FILE", help="show speedups against results saved with --save")
+    args = parser.parse_args()
+
+    results = run(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,140 @@
+"""
+Synthetic message stream benchmark for the levelling plugin's hot path.
+
+Drives Levelling.on_message and on_raw_message_delete with lightweight stand-ins for guilds, channels and messages,
+and reports handled messages per second, p50/p99 handler latency and resident memory. Events are awaited one after
+another, so the flushes the handlers trigger at flush_threshold show up in the throughput and the latency tail.
+Run from a Red Star install, so that red_star and discord can be imported:
+
+    python _benchmarks/levelling_bench.py --guilds 10 --members 50000 --messages 200000 --deletes 0.05
+"""
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter, perf_counter_ns
+from types import SimpleNamespace
+import asyncio
+import logging
+import random
+import resource
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from discord.utils import time_snowflake
+from levelling import Levelling
+
+
+class FakeConfigFile(dict):
+    def save(self):
+        pass
+
+
+class FakeGuild:
+    def __init__(self, gid: int, channels: int):
+        self.id = gid
+        self.text_channels = [SimpleNamespace(id=gid * 1000 + i, guild=self) for i in range(channels)]
+
+
+class FakeMessage:
+    __slots__ = ("id", "guild", "channel", "author", "content", "clean_content", "created_at")
+
+    def __init__(self, mid: int, guild: FakeGuild, channel, author, content: str):
+        self.id = mid
+        self.guild = guild
+        self.channel = channel
+        self.author = author
+        self.content = self.clean_content = content
+        self.created_at = datetime.now(timezone.utc)
+
+
+def rss_mb() -> float:
+    """
+    Current resident set size in MiB, falling back to the peak where /proc isn't available.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 2 ** 20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentile(sorted_values: list, pct: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100))]
+
+
+async def make_plugin(storage_dir: Path, args) -> Levelling:
+    plugin = Levelling.__new__(Levelling)
+    plugin.plugin_config = {**Levelling.default_config, "storage": args.storage,
+                            "default": {**Levelling.default_config["default"], "cooldown": args.cooldown}}
+    plugin.config_manager = SimpleNamespace(get_plugin_config_file=lambda name: FakeConfigFile())
+    plugin.channel_manager = SimpleNamespace(channel_in_category=lambda guild, category, channel: False)
+    plugin.logger = logging.getLogger("levelling_bench")
+    guilds = {gid: FakeGuild(gid, args.channels) for gid in range(1, args.guilds + 1)}
+    plugin.client = SimpleNamespace(storage_dir=storage_dir, get_guild=guilds.get, guilds=list(guilds.values()))
+    await plugin.activate()
+    return plugin
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    with TemporaryDirectory() as storage_dir:
+        plugin = await make_plugin(Path(storage_dir), args)
+        guilds = plugin.client.guilds
+        authors = [SimpleNamespace(id=uid, display_name=f"member{uid}") for uid in range(1, args.members + 1)]
+        texts = ["x" * length for length in range(0, 2001, 25)]
+        mid = time_snowflake(datetime.now(timezone.utc))
+        sent = []
+        rss_before = rss_mb()
+
+        latencies = []
+        interval = 1 / args.rate if args.rate else 0
+        start = perf_counter()
+        for i in range(args.messages):
+            if sent and rng.random() < args.deletes:
+                msg = sent.pop(rng.randrange(len(sent)))
+                payload = SimpleNamespace(message_id=msg.id, cached_message=msg if rng.random() < 0.5 else None)
+                t = perf_counter_ns()
+                await plugin.on_raw_message_delete(payload)
+            else:
+                guild = rng.choice(guilds)
+                mid += 1
+                msg = FakeMessage(mid, guild, rng.choice(guild.text_channels), rng.choice(authors),
+                                  rng.choice(texts))
+                t = perf_counter_ns()
+                await plugin.on_message(msg)
+                if len(sent) < 10000:
+                    sent.append(msg)
+            latencies.append(perf_counter_ns() - t)
+            if interval:
+                await asyncio.sleep(max(0.0, start + (i + 1) * interval - perf_counter()))
+        elapsed = perf_counter() - start
+
+        flush_start = perf_counter()
+        await plugin.deactivate()
+        flush_time = perf_counter() - flush_start
+
+    latencies.sort()
+    print(f"events:       {args.messages} over {args.guilds} guilds, {args.members} members, "
+          f"{args.storage} storage")
+    print(f"throughput:   {args.messages / elapsed:,.0f} events/s")
+    print(f"latency p50:  {percentile(latencies, 50) / 1000:.1f} µs")
+    print(f"latency p99:  {percentile(latencies, 99) / 1000:.1f} µs")
+    print(f"latency max:  {latencies[-1] / 1000:.1f} µs")
+    print(f"final flush:  {flush_time * 1000:.1f} ms")
+    print(f"RSS:          {rss_before:.1f} MiB before, {rss_mb():.1f} MiB after")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmark the levelling plugin's message handlers.")
+    parser.add_argument("--guilds", type=int, default=5)
+    parser.add_argument("--channels", type=int, default=20, help="text channels per guild")
+    parser.add_argument("--members", type=int, default=10000, help="distinct message authors")
+    parser.add_argument("--messages", type=int, default=100000, help="number of events to send")
+    parser.add_argument("--deletes", type=float, default=0.02, help="fraction of events that are deletions")
+    parser.add_argument("--rate", type=float, default=0, help="target events per second, 0 for unthrottled")
+    parser.add_argument("--cooldown", type=int, default=0)
+    parser.add_argument("--storage", choices=("json", "sqlite"), default="json")
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(run(parser.parse_args()))
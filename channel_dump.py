@@ -2,18 +2,108 @@ from red_star.plugin_manager import BasePlugin
 from red_star.rs_utils import respond
 from red_star.command_dispatcher import Command
 from red_star.rs_errors import CommandSyntaxError
-from discord import File, NotFound
-from io import BytesIO
+from discord import File, NotFound, Object
+from array import array
+from gzip import GzipFile
+from tempfile import SpooledTemporaryFile, TemporaryFile
+from zipfile import ZipFile, ZIP_DEFLATED
+import asyncio
+
+
+def format_message(message, end: str = "\n\n") -> str:
+    return f"{str(message.author)} @ {str(message.created_at.strftime('%Y-%m-%d %H:%M:%S'))}\n" \
+           f"{message.clean_content}{end}"
+
+
+class DumpWriter:
+    """
+    Writes a channel dump into temporary files as the messages come in, compressing on the fly and starting a new
+    numbered part whenever the current one gets close to the size limit.
+    """
+    # compressors hold back some output, so compressed parts are closed this far below the limit
+    margin = 256 * 1024
+
+    def __init__(self, name: str, compression: str, part_size: int):
+        self.name = name
+        self.compression = compression
+        self.part_size = part_size
+        self.part = 0
+        self._open()
+
+    def _open(self):
+        self.part += 1
+        self.written = False
+        self.fp = TemporaryFile()
+        name = self.name if self.part == 1 else f"{self.name}.part{self.part}"
+        if self.compression == "gzip":
+            self.stream = GzipFile(filename=name + ".txt", mode="wb", fileobj=self.fp)
+        elif self.compression == "zip":
+            self.zip = ZipFile(self.fp, "w", ZIP_DEFLATED)
+            self.stream = self.zip.open(name + ".txt", "w", force_zip64=True)
+        else:
+            self.stream = self.fp
+
+    def _finish(self, last: bool) -> tuple:
+        if self.compression == "gzip":
+            self.stream.close()
+        elif self.compression == "zip":
+            self.stream.close()
+            self.zip.close()
+        self.fp.seek(0)
+        name = self.name if last and self.part == 1 else f"{self.name}.part{self.part}"
+        extension = {"gzip": ".txt.gz", "zip": ".zip"}.get(self.compression, ".txt")
+        return self.fp, name + extension
+
+    def write(self, text):
+        """
+        :param text: str, or already encoded bytes
+        :return: (file, filename) of the part that was completed to make room for the text, or None
+        """
+        data = text.encode("utf-8") if isinstance(text, str) else text
+        finished = None
+        margin = self.margin if self.compression in ("gzip", "zip") else 0
+        if self.written and self.fp.tell() + margin + len(data) > self.part_size:
+            finished = self._finish(last=False)
+            self._open()
+        self.stream.write(data)
+        self.written = True
+        return finished
+
+    def close(self) -> tuple:
+        """
+        :return: (file, filename) of the last part
+        """
+        return self._finish(last=True)
+
+    def discard(self):
+        """
+        Closes the current part without returning it, for when the dump fails. Harmless after close.
+        """
+        try:
+            if self.compression in ("gzip", "zip"):
+                self.stream.close()
+            if self.compression == "zip":
+                self.zip.close()
+        finally:
+            self.fp.close()
 
 
 class DumpChannel(BasePlugin):
     name = "dump_channel"
-    version = "1.0"
+    version = "1.1"
     author = "GTG3000"
     description = "A plugin for dumping messages in a channel to a text file."
+    default_config = {
+        "compression": "gzip",  # gzip, zip or none
+        "part_size": 8 * 1024 * 1024,  # dumps are split into parts of at most this many bytes
+        "spool_size": 1024 * 1024,  # fetched windows larger than this are kept on disk
+        "fetch_windows": 16,  # the range to dump is split into this many windows, fetched concurrently
+        "fetch_concurrency": 4  # how many windows are fetched at once
+    }
 
     @Command("Dump",
-             doc="Dumps the messages between two specified messages into a text file, inclusively.",
+             doc="Dumps the messages between two specified messages into a text file, inclusively.\n"
+                 "The file is compressed, and long dumps are split into several numbered parts.",
              syntax="(latest message ID) (earliest message ID) [filename]",
              perms={"manage_messages"},
              run_anywhere=True)
@@ -40,21 +130,69 @@ class DumpChannel(BasePlugin):
             raise CommandSyntaxError(f"No message with ID {m_end}")
 
         if len(args) > 3:
-            t_name = args[3]+".txt"
+            t_name = args[3]
         else:
-            t_name = str(msg.created_at.timestamp())+".txt"
+            t_name = str(msg.created_at.timestamp())
 
-        s = "%Y-%m-%d %H:%M:%S"
-
-        t_list = [f"{str(m_end.author)} @ {str(m_end.created_at.strftime(s))}\n{m_end.clean_content}\n\n"]
+        t_msg = await respond(msg, f"**AFFIRMATIVE. Processing file {t_name}.**")
+        writer = DumpWriter(t_name, self.plugin_config['compression'], self.plugin_config['part_size'])
 
-        async for msg in msg.channel.history(before=m_start, after=m_end, oldest_first=True, limit=None):
-            t_list.append(f"{str(msg.author)} @ {str(msg.created_at.strftime(s))}\n{msg.clean_content}\n\n")
+        async def upload(part, text):
+            fp, filename = part
+            with fp:
+                await respond(msg, text, file=File(fp, filename=filename))
 
-        t_list.append(f"{str(m_start.author)} @ {str(m_start.created_at.strftime(s))}\n{m_start.clean_content}")
+        # snowflakes begin with their timestamp, so evenly spaced IDs make evenly spaced windows of time
+        windows = max(self.plugin_config['fetch_windows'], 1)
+        bounds = [m_end.id + (m_start.id - m_end.id) * i // windows for i in range(windows + 1)]
+        semaphore = asyncio.Semaphore(max(self.plugin_config['fetch_concurrency'], 1))
+        tasks = [asyncio.ensure_future(self._fetch_window(msg.channel, bounds[i],
+                                                          bounds[i + 1] + 1 if i < windows - 1 else bounds[i + 1],
+                                                          semaphore))
+                 for i in range(windows)]
 
-        t_msg = await respond(msg, f"**AFFIRMATIVE. Processing file {t_name}.**")
         async with msg.channel.typing():
-            await respond(msg, "**AFFIRMATIVE. Completed file upload.**",
-                          file=File(BytesIO(bytes("".join(t_list), encoding="utf-8")), filename=t_name))
+            try:
+                writer.write(format_message(m_end))
+                # the windows don't overlap, so writing them out one after another keeps the messages in order
+                for task in tasks:
+                    fp, lengths = await task
+                    with fp:
+                        for length in lengths:
+                            part = writer.write(fp.read(length))
+                            if part:
+                                await upload(part, f"**AFFIRMATIVE. Uploading part {writer.part - 1} "
+                                                   f"of file {t_name}.**")
+                part = writer.write(format_message(m_start, end=""))
+                if part:
+                    await upload(part, f"**AFFIRMATIVE. Uploading part {writer.part - 1} of file {t_name}.**")
+
+                await upload(writer.close(), "**AFFIRMATIVE. Completed file upload.**")
+            finally:
+                # if anything failed, the windows fetched so far and the part being written still hold files
+                for task in tasks:
+                    if task.done() and not task.cancelled() and not task.exception():
+                        task.result()[0].close()
+                    task.cancel()
+                writer.discard()
         await t_msg.delete()
+
+    async def _fetch_window(self, channel, after: int, before: int, semaphore: asyncio.Semaphore) -> tuple:
+        """
+        Fetches the messages between two IDs, exclusively, into a spooled file, oldest first.
+        :return: the file, rewound, and an array of the encoded lengths of the messages in it
+        """
+        fp = SpooledTemporaryFile(max_size=self.plugin_config['spool_size'])
+        lengths = array("L")
+        try:
+            async with semaphore:
+                async for message in channel.history(before=Object(before), after=Object(after), oldest_first=True,
+                                                     limit=None):
+                    data = format_message(message).encode("utf-8")
+                    fp.write(data)
+                    lengths.append(len(data))
+        except BaseException:
+            fp.close()
+            raise
+        fp.seek(0)
+        return fp, lengths
@@ -2,13 +2,31 @@ from red_star.plugin_manager import BasePlugin
 from red_star.rs_utils import respond
 from red_star.command_dispatcher import Command
 from red_star.rs_errors import CommandSyntaxError
-from random import randint
-from collections import defaultdict
+from discord import File
+from random import choices
+from collections import Counter
 from enum import Enum
+from functools import lru_cache
+from itertools import chain
+from gzip import GzipFile
+from io import BytesIO
+from math import inf, isnan
+import asyncio
+import heapq
+from typing import NamedTuple, Union
+import operator
 import re
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-roll_tokens = re.compile(r"\d+(?:\.\d+)?|d(?:\d+|f)[da]?|[+\-/*()]")
+
+roll_tokens = re.compile(r"\d+(?:\.\d+)?|d(?:\d+(?:k[hl]\d*|d[hl]\d*|r\d+|!)*|f)[da]?|[+\-/*()]")
+dice_token = re.compile(r"d(\d+|f)(.*?)([da]?)")
+dice_modifiers = re.compile(r"k[hl]\d*|d[hl]\d*|r\d+|!")
+batch_prefix = re.compile(r"x(\d+)\s+", re.IGNORECASE)
 
 
 class Adv(Enum):
@@ -17,130 +35,876 @@ class Adv(Enum):
     d = 2
 
 
-def parse_roll(roll_string: str):
-    rolls = []
-
-    def rpn(string: str):
-        # tokenize by only finding the valid operators
-        tokens = roll_tokens.findall(string.lower())
-
-        # turn into reverse polish notation for easier parsing
-        prec = defaultdict(lambda: 3, {
-            '(': 0,
-            '-': 1,
-            '+': 1,
-            '*': 2,
-            '/': 2
-        })
-
-        polish = []
-        ops = []
-        unary_minus_flag = True  # ugh
-        new_expr_flag = False  # because people may not write right
-
-        for token in tokens:
+# operator precedence for the conversion to reverse polish notation, anything not listed binds tightest
+precedence = {
+    '(': 0,
+    '-': 1,
+    '+': 1,
+    '*': 2,
+    '/': 2
+}
+
+binary_ops = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.truediv
+}
+
+# pools of at least this many dice are drawn with NumPy, if it's available
+numpy_threshold = 64
+# the most times a die can explode in a row
+explode_depth = 20
+rng = numpy.random.default_rng() if numpy else None
+
+# opcodes of compiled roll programs
+PUSH, NEG, BINARY, ROLL = range(4)
+
+
+class Dice(NamedTuple):
+    sides: Union[int, str]
+    adv: Adv
+    counted: bool  # whether the number of dice is taken off the stack, or is 1
+    select: str = ''  # kh, kl, dh or dl, to keep or drop the highest or lowest dice
+    select_count: int = 0
+    explode: bool = False  # whether dice showing the highest side are rolled again and added
+    reroll: int = 0  # dice showing this or lower are rerolled once
+
+    @classmethod
+    def from_token(cls, token: str, counted: bool) -> "Dice":
+        sides, modifiers, adv = dice_token.fullmatch(token).groups()
+        adv = Adv.a if adv == 'a' else (Adv.d if adv == 'd' else Adv.n)
+        if sides == 'f':
+            return cls('f', adv, counted)
+        sides = min(max(int(sides), 2), 10000)
+        select, select_count, explode, reroll = '', 0, False, 0
+        for modifier in dice_modifiers.findall(modifiers):
+            if modifier == '!':
+                explode = True
+            elif modifier[0] == 'r':
+                reroll = min(int(modifier[1:]), sides)
+            else:
+                select, select_count = modifier[:2], min(int(modifier[2:] or 1), 10000)
+        return cls(sides, adv, counted, select, select_count, explode, reroll)
+
+    def keep(self, num: int) -> int:
+        """
+        :return: how many of num dice are kept
+        """
+        if self.select in ('kh', 'kl'):
+            return min(self.select_count, num)
+        if self.select in ('dh', 'dl'):
+            return max(num - self.select_count, 0)
+        return num
+
+    def __str__(self):
+        return f"d{self.sides}{f'r{self.reroll}' if self.reroll else ''}{'!' if self.explode else ''}" \
+               f"{f'{self.select}{self.select_count}' if self.select else ''}" \
+               f"{'a' if self.adv == Adv.a else ('d' if self.adv == Adv.d else '')}"
+
+
+class Program(NamedTuple):
+    expression: str  # normalized expression, tokens separated by single spaces
+    ops: tuple  # (opcode, argument) pairs
+    tokens: int  # number of tokens in the expression
+    depth: int  # greatest stack depth reached during evaluation
+    dice: int  # upper bound of the number of dice drawn during evaluation
+
+
+def to_rpn(tokens: list) -> list:
+    """
+    Converts a list of tokens into reverse polish notation, using a shunting yard that tolerates missing operators
+    between numbers, so that people can write several expressions in one.
+    """
+    polish = []
+    ops = []
+    unary_minus_flag = True  # ugh
+    new_expr_flag = False  # because people may not write right
+
+    for token in tokens:
+        try:
             try:
-                try:
-                    val = int(token)
-                except ValueError:
-                    val = float(token)
+                val = int(token)
+            except ValueError:
+                val = float(token)
 
-                if new_expr_flag:
-                    polish.extend(ops[::-1])
-                    ops = []
+            if new_expr_flag:
+                polish.extend(ops[::-1])
+                ops = []
 
-                polish.append(val)
+            polish.append(val)
+            unary_minus_flag = False
+            new_expr_flag = True
+        except ValueError:
+            new_expr_flag = False
+            if token == '(':
+                ops.append(token)
+                unary_minus_flag = True
+            elif token == ')':
+                while ops and ops[-1] != '(':
+                    polish.append(ops.pop())
+                if ops:
+                    ops.pop()
                 unary_minus_flag = False
-                new_expr_flag = True
-            except ValueError:
-                new_expr_flag = False
-                if token == '(':
-                    ops.append(token)
-                    unary_minus_flag = True
-                elif token == ')':
-                    while ops and ops[-1] != '(':
-                        polish.append(ops.pop())
-                    if ops:
-                        ops.pop()
-                    unary_minus_flag = False
-                elif token[0] == 'd':
-                    polish.append(token)
-                    unary_minus_flag = False
+            elif token[0] == 'd':
+                polish.append(token)
+                unary_minus_flag = False
+            else:
+                # unary minuses are hard.
+                if unary_minus_flag and token == '-':
+                    token = '_'
+                unary_minus_flag = token in '*/+-'
+
+                # as cool as it would be to have strings of data then strings of operators, this works better
+                while ops and precedence.get(ops[-1], 3) >= precedence.get(token, 3):
+                    polish.append(ops.pop())
+                ops.append(token)
+
+    polish.extend(ops[::-1])
+
+    return polish
+
+
+@lru_cache(maxsize=1024)
+def compile_roll(roll_string: str) -> Program:
+    """
+    Compiles a roll expression into an immutable program. The stack depth at every step is known in advance, so
+    operators without enough operands (which evaluate to nothing) are dropped here instead of checked on every roll.
+    """
+    tokens = roll_tokens.findall(roll_string.lower())
+    ops = []
+    # the range of values each stack slot can take, to bound the size of dice pools whose count is rolled
+    bounds = []
+    max_depth = 0
+    dice = 0
+    for token in to_rpn(tokens):
+        if isinstance(token, (int, float)):
+            ops.append((PUSH, token))
+            value = to_float(token)
+            bounds.append((value, value))
+        elif token in binary_ops:
+            if len(bounds) > 1:
+                ops.append((BINARY, binary_ops[token]))
+                x = bounds.pop()
+                bounds[-1] = interval_op(binary_ops[token], bounds[-1], x)
+        elif token == '_':
+            if bounds:
+                ops.append((NEG, None))
+                low, high = bounds[-1]
+                bounds[-1] = (-high, -low)
+        elif token[0] == 'd':
+            die = Dice.from_token(token, bool(bounds))
+            ops.append((ROLL, die))
+            low, high = bounds.pop() if bounds else (1, 1)
+            low, high = round(min(max(low, 1), 10000)), round(min(max(high, 1), 10000))
+            die_low, die_high = (-1, 1) if die.sides == 'f' else (1, die.sides)
+            if die.explode:
+                die_high *= explode_depth + 1
+            bounds.append((min(low * die_low, high * die_low, 0), max(low * die_high, high * die_high)))
+            dice += high * (1 + bool(die.reroll) + die.explode * explode_depth) * (1 if die.adv == Adv.n else 2)
+        max_depth = max(max_depth, len(bounds))
+    return Program(' '.join(tokens), tuple(ops), len(tokens), max_depth, dice)
+
+
+def to_float(value) -> float:
+    try:
+        return float(value)
+    except OverflowError:
+        return inf if value > 0 else -inf
+
+
+def interval_op(op, a: tuple, b: tuple) -> tuple:
+    """
+    Applies an arithmetic operator to two (low, high) ranges.
+    :return: the range of possible results
+    """
+    if op is operator.truediv and b[0] <= 0 <= b[1]:
+        return -inf, inf
+    results = [op(x, y) for x in a for y in b]
+    if any(isnan(x) for x in results):
+        return -inf, inf
+    return min(results), max(results)
+
+
+def draw(low: int, high: int, num: int):
+    """
+    Draws a pool of num dice with values from low to high inclusive, in one batch. Small pools are drawn with
+    random.choices, since NumPy's per-call overhead outweighs its speed below a few dozen dice.
+    :return: list or NumPy array of the values
+    """
+    if numpy and num >= numpy_threshold:
+        return rng.integers(low, high, size=num, endpoint=True)
+    return choices(range(low, high + 1), k=num)
+
+
+def roll_pool(dice: Dice, num: int) -> tuple:
+    """
+    Rolls a pool of num of the given dice, then applies rerolls, explosions and keep/drop selection, in that order.
+    Selection picks the kept dice with a heap or a partition rather than sorting the pool.
+    :return: the total of the kept dice, and the values of all dice
+    """
+    low, high = (-1, 1) if dice.sides == 'f' else (1, dice.sides)
+    pool = draw(low, high, num)
+    array = not isinstance(pool, list)
+
+    if dice.reroll:
+        if array:
+            redo = pool <= dice.reroll
+            pool[redo] = draw(low, high, int(redo.sum()))
+        else:
+            redo = [i for i, value in enumerate(pool) if value <= dice.reroll]
+            for i, value in zip(redo, draw(low, high, len(redo))):
+                pool[i] = value
+
+    if dice.explode:
+        # extra dice add to the die that exploded, so that keeping and dropping treats the chain as one die
+        if array:
+            origins = numpy.flatnonzero(pool == high)
+        else:
+            origins = [i for i, value in enumerate(pool) if value == high]
+        for _ in range(explode_depth):
+            if not len(origins):
+                break
+            batch = draw(low, high, len(origins))
+            if array:
+                batch = numpy.asarray(batch)
+                pool[origins] += batch
+                origins = origins[batch == high]
+            else:
+                for i, value in zip(origins, batch):
+                    pool[i] += value
+                origins = [i for i, value in zip(origins, batch) if value == high]
+
+    kept = pool
+    if dice.select:
+        keep = dice.keep(len(pool))
+        highest = dice.select in ('kh', 'dl')
+        if not keep:
+            kept = []
+        elif keep < len(pool):
+            if array:
+                kept = numpy.partition(pool, len(pool) - keep)[len(pool) - keep:] if highest \
+                    else numpy.partition(pool, keep - 1)[:keep]
+            else:
+                kept = heapq.nlargest(keep, pool) if highest else heapq.nsmallest(keep, pool)
+    return (sum(kept) if isinstance(kept, list) else int(kept.sum())), pool
+
+
+def roll_dice(dice: Dice, num: int, rolls: list = None) -> int:
+    """
+    Rolls num of the given dice. The second pool is only drawn for advantage and disadvantage.
+    :param rolls: if given, (num, dice, total, pool) is logged into it
+    :return: the total
+    """
+    total, pool = roll_pool(dice, num)
+    if dice.adv != Adv.n:
+        other_total, other = roll_pool(dice, num)
+        if other_total > total if dice.adv == Adv.a else other_total < total:
+            pool, total = other, other_total
+
+    if rolls is not None:
+        rolls.append((num, dice, total, pool))
+    return total
+
+
+def roll_log(rolls: list):
+    """
+    Formats the log of rolled dice a piece at a time, so that consumers can stop as soon as they have enough. Each
+    pool takes a line.
+    :param rolls: list of (num, dice, total, pool) as logged by roll_dice
+    :return: generator of strings
+    """
+    for num, dice, total, pool in rolls:
+        yield f"{num}{dice} - {total:2d} ["
+        for i in range(0, len(pool), 100):
+            chunk = pool[i:i + 100]
+            yield ", ".join(map(str, chunk if isinstance(chunk, list) else chunk.tolist())) + \
+                (", " if i + 100 < len(pool) else "]\n")
+
+
+def compress_log(rolls: list) -> BytesIO:
+    """
+    Writes the complete log of rolled dice into a gzip compressed file, without building it as one string first.
+    """
+    _file = BytesIO()
+    with GzipFile(filename="rolls.txt", mode="wb", fileobj=_file) as gz:
+        for piece in roll_log(rolls):
+            gz.write(piece.encode("utf-8"))
+    _file.seek(0)
+    return _file
+
+
+def run_program(program: Program, log: bool = True):
+    """
+    Evaluates a compiled roll program.
+    :param log: whether to log the individual dice
+    :return: the values left on the stack and the log of rolled dice
+    """
+    stack = []
+    rolls = [] if log else None
+    for code, arg in program.ops:
+        if code == PUSH:
+            stack.append(arg)
+        elif code == BINARY:
+            x = stack.pop()
+            stack[-1] = arg(stack[-1], x)
+        elif code == NEG:
+            stack[-1] = -stack[-1]
+        else:
+            num = min(max(round(stack.pop()), 1), 10000) if arg.counted else 1
+            stack.append(roll_dice(arg, num, rolls))
+    return stack, rolls
+
+
+def parse_roll(roll_string: str):
+    return run_program(compile_roll(roll_string))
+
+
+def run_batch(programs: list, times: int) -> list:
+    """
+    Evaluates each program the given number of times, without logging the dice.
+    :return: for each program, the list of values each evaluation left on the stack
+    """
+    return [[run_program(program, log=False)[0] for _ in range(times)] for program in programs]
+
+
+def format_number(x) -> str:
+    if isinstance(x, int):
+        # integers can be too large to convert to float
+        return str(x)
+    return f"{round(x, 2) + 0.0:.2f}".rstrip('0').rstrip('.')
+
+
+def mean(values: list):
+    total = sum(values)
+    try:
+        return total / len(values)
+    except OverflowError:
+        return total // len(values)
+
+
+# limits of exact distribution analysis: distinct outcomes of one value, and multiply-adds per expression
+max_outcomes = 1 << 20
+max_work = 1 << 26 if numpy else 1 << 22
+
+
+def fft_size(size: int) -> int:
+    # FFTs of awkward lengths are many times slower than of powers of two
+    return 1 << (size - 1).bit_length()
+
+
+def convolve_work(m: int, n: int) -> int:
+    """
+    Approximate multiply-adds convolve takes for sequences of the given lengths.
+    """
+    if numpy and min(m, n) >= 64:
+        size = fft_size(m + n - 1)
+        return 3 * size * size.bit_length()
+    return m * n
+
+
+def convolve(a, b):
+    """
+    Distribution of the sum of two independent integer values, given their probabilities. Large inputs are convolved
+    through an FFT if NumPy is available.
+    """
+    if numpy:
+        if min(len(a), len(b)) < 64:
+            return numpy.convolve(a, b)
+        size = len(a) + len(b) - 1
+        out = numpy.fft.irfft(numpy.fft.rfft(a, fft_size(size)) * numpy.fft.rfft(b, fft_size(size)))[:size]
+        return numpy.clip(out, 0, None)
+    if len(a) * len(b) > max_work:
+        raise ValueError("Expression has too many possible outcomes to analyse.")
+    out = [0.0] * (len(a) + len(b) - 1)
+    for i, x in enumerate(a):
+        if x:
+            for j, y in enumerate(b, i):
+                out[j] += x * y
+    return out
+
+
+def die_distribution(dice: Dice) -> tuple:
+    """
+    Distribution of the value of a single die, after rerolls and explosions.
+    :return: the lowest value, and the probabilities of the values from it up
+    """
+    low, high = (-1, 1) if dice.sides == 'f' else (1, dice.sides)
+    base = [1 / (high - low + 1)] * (high - low + 1)
+    probs = base
+    if dice.reroll:
+        redo = sum(base[:dice.reroll - low + 1])
+        probs = [p * redo + (p if value > dice.reroll else 0.0) for value, p in enumerate(base, low)]
+    if dice.explode:
+        # a die that can explode k more times shows a side below the highest, or the highest plus a die that can
+        # explode k - 1 more times
+        chain = base
+        for _ in range(explode_depth - 1):
+            chain = base[:-1] + [0.0] + [base[-1] * p for p in chain]
+        probs = probs[:-1] + [0.0] + [probs[-1] * p for p in chain]
+    return low, numpy.array(probs) if numpy else probs
+
+
+def pools(die, counts):
+    """
+    Distributions of the sum of n independent dice, for each n in counts. With NumPy every pool is one FFT;
+    otherwise dice are added one at a time, reusing smaller pools for larger ones, with a sliding window if all
+    sides are equally likely.
+    :param die: probabilities of the sides of one die, lowest first
+    :return: generator of (n, probabilities of the sum, lowest first)
+    """
+    if numpy:
+        for n in counts:
+            size = n * (len(die) - 1) + 1
+            yield n, numpy.clip(numpy.fft.irfft(numpy.fft.rfft(die, fft_size(size)) ** n)[:size], 0, None)
+        return
+    faces = len(die)
+    uniform = len(set(die)) == 1
+    pool = [1.0]
+    for n in range(1, max(counts) + 1):
+        if uniform:
+            out = []
+            window = 0.0
+            for i in range(len(pool) + faces - 1):
+                if i < len(pool):
+                    window += pool[i]
+                if i >= faces:
+                    window -= pool[i - faces]
+                out.append(window / faces)
+            pool = out
+        else:
+            pool = convolve(pool, die)
+        if n in counts:
+            yield n, pool
+
+
+def select_pool(die, n: int, keep: int, highest: bool):
+    """
+    Distribution of the sum of the keep highest (or lowest) of n independent dice. Goes through the sides from the
+    kept end, choosing how many of the dice not yet placed show each side; binomial weights make that exact without
+    going through the rolls. Once keep dice are placed, the rest no longer matter.
+    :param die: probabilities of the sides of one die, lowest first
+    :return: probabilities of the kept sum, in steps of one side above the lowest
+    """
+    faces = len(die)
+    order = list(range(faces - 1, -1, -1) if highest else range(faces))
+    size = keep * (faces - 1) + 1
+    done = numpy.zeros(size) if numpy else [0.0] * size
+    start = numpy.zeros(size) if numpy else [0.0] * size
+    start[0] = 1.0
+    states = {0: start}  # dice placed so far, fewer than keep: probabilities of the kept sum
+    rest = 1.0
+    for face in order:
+        p = float(die[face])
+        rest = max(rest - p, 0.0)
+        new = {}
+        for placed, sums in states.items():
+            free = n - placed
+            weight = 1.0
+            for c in range(free + 1):
+                if c:
+                    weight *= (free - c + 1) / c * p
+                    if not weight:
+                        break
+                shift = min(c, keep - placed) * face
+                if placed + c >= keep:
+                    target, factor = done, weight * rest ** (free - c)
                 else:
-                    # unary minuses are hard.
-                    if unary_minus_flag and token == '-':
-                        token = '_'
-                    unary_minus_flag = token in '*/+-'
+                    target, factor = new.setdefault(placed + c, numpy.zeros(size) if numpy else [0.0] * size), weight
+                if numpy:
+                    target[shift:] += factor * sums[:size - shift]
+                else:
+                    for i, x in enumerate(sums):
+                        if x:
+                            target[i + shift] += factor * x
+        states = new
+    return done
+
+
+def best_of_two(probs, highest: bool):
+    """
+    Distribution of the higher (or lower) of two independent values with the same distribution.
+    """
+    if numpy:
+        cdf = numpy.cumsum(probs)
+        if highest:
+            return numpy.diff(cdf ** 2, prepend=0.0)
+        survival = 1 - cdf + probs  # P(X >= k)
+        return survival ** 2 - numpy.append(survival[1:] ** 2, 0.0)
+    out = []
+    cdf = 0.0
+    for p in probs:
+        if highest:
+            out.append((cdf + p) ** 2 - cdf ** 2)
+        else:
+            out.append((1 - cdf) ** 2 - (1 - cdf - p) ** 2)
+        cdf += p
+    return out
+
 
-                    # as cool as it would be to have strings of data then strings of operators, this works better
-                    while ops and prec[ops[-1]] >= prec[token]:
-                        polish.append(ops.pop())
-                    ops.append(token)
+class Distribution:
+    """
+    Exact probability distribution of the value of a dice expression. Integer valued distributions are dense, a
+    sequence of probabilities for the values from offset up. Fractional ones (after a division, say) are sparse,
+    a {value: probability} dict.
+    """
+    __slots__ = ("offset", "probs", "points")
 
-        polish.extend(ops[::-1])
+    def __init__(self, offset: int = 0, probs=None, points: dict = None):
+        self.offset = offset
+        self.probs = probs
+        self.points = points
 
-        return polish
+    @classmethod
+    def point(cls, value) -> "Distribution":
+        return cls.from_points({value: 1.0})
 
-    def roll(dice: str, stack: list):
-        num = min(max(round(stack.pop()), 1), 10000) if stack else 1
+    @classmethod
+    def from_points(cls, points: dict) -> "Distribution":
+        if all(float(value).is_integer() for value in points):
+            low, high = int(min(points)), int(max(points))
+            if high - low < max_outcomes:
+                probs = numpy.zeros(high - low + 1) if numpy else [0.0] * (high - low + 1)
+                for value, p in points.items():
+                    probs[int(value) - low] += p
+                return cls(low, probs)
+        return cls(points=points)
 
-        if dice[-1] in 'ad':
-            reroll = Adv.a if dice[-1] == 'a' else Adv.d
-            side = 'f' if dice[1:-1] == 'f' else int(dice[1:-1])
+    @classmethod
+    def from_samples(cls, samples) -> "Distribution":
+        """
+        Empirical distribution of a sequence of trial results.
+        """
+        if not numpy:
+            return cls.from_points({value: count / len(samples) for value, count in Counter(samples).items()})
+        samples = numpy.asarray(samples, dtype=float)
+        if numpy.isfinite(samples).all() and (samples == numpy.round(samples)).all() and \
+                samples.max() - samples.min() < max_outcomes:
+            low = int(samples.min())
+            return cls(low, numpy.bincount((samples - low).astype(numpy.int64)) / len(samples))
+        values, counts = numpy.unique(samples, return_counts=True)
+        return cls(points=dict(zip(values.tolist(), (counts / len(samples)).tolist())))
+
+    @staticmethod
+    def plan_dice(die: Dice, count: "Distribution") -> tuple:
+        """
+        Works out how to build the distribution of rolling a number of dice given by another distribution, so the
+        cost can be checked before doing it.
+        :return: the plan for Distribution.dice, the last item of which is the approximate amount of multiply-adds
+        """
+        counts = {}
+        for value, p in count.items():
+            n = min(max(round(value), 1), 10000)
+            counts[n] = counts.get(n, 0.0) + p
+        low, probs = die_distribution(die)
+        faces = len(probs)
+        keep = {n: die.keep(n) for n in counts}
+        offset = min(k * low for k in keep.values())
+        size = max(k * (low + faces - 1) for k in keep.values()) - offset + 1
+        whole = [n for n in counts if keep[n] == n]
+        selected = [n for n in counts if 0 < keep[n] < n]
+        if whole:
+            work = len(whole) * size if numpy else max(whole) * size * (faces if die.reroll or die.explode else 1)
         else:
-            reroll = Adv.n
-            side = 'f' if dice[1:] == 'f' else int(dice[1:])
+            work = 0
+        work += sum(faces * keep[n] * n * (keep[n] * (faces - 1) + 1) for n in selected)
+        return die, counts, keep, low, probs, offset, size, work
+
+    @classmethod
+    def dice(cls, plan: tuple) -> "Distribution":
+        """
+        Distribution of rolling a number of dice given by another distribution, as planned by plan_dice.
+        """
+        die, counts, keep, low, probs, offset, size, work = plan
+        if size > max_outcomes or work > max_work:
+            raise ValueError("Expression has too many possible outcomes to analyse.")
+        whole = [n for n in counts if keep[n] == n]
+        selected = [n for n in counts if 0 < keep[n] < n]
+
+        out = numpy.zeros(size) if numpy else [0.0] * size
+        results = chain(pools(probs, whole) if whole else (),
+                        ((n, select_pool(probs, n, keep[n], die.select in ('kh', 'dl'))) for n in selected),
+                        ((n, [1.0]) for n in counts if not keep[n]))
+        for n, pool in results:
+            if die.adv != Adv.n:
+                pool = best_of_two(pool, die.adv == Adv.a)
+            start = keep[n] * low - offset
+            if numpy:
+                out[start:start + len(pool)] += counts[n] * numpy.asarray(pool)
+            else:
+                for i, x in enumerate(pool, start):
+                    out[i] += counts[n] * x
+        return cls(offset, out)
 
-        if side == 'f':
-            def diceroll():
-                return randint(-1, 1)
+    def __len__(self):
+        return len(self.points) if self.probs is None else len(self.probs)
+
+    def items(self):
+        """
+        Iterates over (value, probability) pairs of possible values, in ascending order.
+        """
+        if self.probs is None:
+            return sorted(self.points.items())
+        return ((value, p) for value, p in enumerate(self.probs, self.offset) if p)
+
+    def _combine(self, other: "Distribution", op) -> "Distribution":
+        # goes through every pair of values in Python, hence the smaller limit
+        if len(self) * len(other) > max_work >> 4:
+            raise ValueError("Expression has too many possible outcomes to analyse.")
+        points = {}
+        for x, p in self.items():
+            for y, q in other.items():
+                value = op(x, y)
+                points[value] = points.get(value, 0.0) + p * q
+        return Distribution.from_points(points)
+
+    def work(self, op, other: "Distribution") -> int:
+        """
+        Approximate multiply-adds it takes to combine with another distribution through a binary operator.
+        """
+        if self.probs is not None and other.probs is not None and op in (operator.add, operator.sub):
+            return convolve_work(len(self.probs), len(other.probs))
+        return len(self) * len(other)
+
+    def __neg__(self):
+        if self.probs is None:
+            return Distribution(points={-value: p for value, p in self.points.items()})
+        return Distribution(-(self.offset + len(self.probs) - 1), self.probs[::-1])
+
+    def __add__(self, other):
+        if self.probs is None or other.probs is None:
+            return self._combine(other, operator.add)
+        if len(other.probs) == 1:
+            return Distribution(self.offset + other.offset, self.probs)
+        if len(self.probs) == 1:
+            return Distribution(self.offset + other.offset, other.probs)
+        if len(self.probs) + len(other.probs) - 1 > max_outcomes:
+            raise ValueError("Expression has too many possible outcomes to analyse.")
+        return Distribution(self.offset + other.offset, convolve(self.probs, other.probs))
+
+    def __sub__(self, other):
+        return self + -other
+
+    def __mul__(self, other):
+        if self.probs is not None and other.probs is not None and len(other.probs) == 1 and other.offset and \
+                (len(self.probs) - 1) * abs(other.offset) < max_outcomes:
+            # scaling by a constant spreads the dense values out, rather than going through every pair
+            factor = other.offset
+            source = self if factor > 0 else -self
+            factor = abs(factor)
+            probs = numpy.zeros((len(source.probs) - 1) * factor + 1) if numpy \
+                else [0.0] * ((len(source.probs) - 1) * factor + 1)
+            probs[::factor] = source.probs
+            return Distribution(source.offset * factor, probs)
+        if self.probs is not None and len(self.probs) == 1 and other.probs is not None:
+            return other * self
+        return self._combine(other, operator.mul)
+
+    def __truediv__(self, other):
+        if other.probability(0):
+            raise ZeroDivisionError("division by zero is possible")
+        return self._combine(other, operator.truediv)
+
+    def probability(self, value) -> float:
+        if self.probs is None:
+            return self.points.get(value, 0.0)
+        if not float(value).is_integer() or not 0 <= value - self.offset < len(self.probs):
+            return 0.0
+        return float(self.probs[int(value) - self.offset])
+
+    def bounds(self) -> tuple:
+        """
+        :return: the lowest and highest possible value
+        """
+        if self.probs is None:
+            return min(self.points), max(self.points)
+        return self.offset, self.offset + len(self.probs) - 1
+
+    def histogram(self, bins: int = 12) -> list:
+        """
+        Groups the possible values into at most the given number of equally wide ranges.
+        :return: list of (lowest value, highest value, probability)
+        """
+        low, high = self.bounds()
+        if len(self) <= bins:
+            return [(value, value, p) for value, p in self.items()]
+        if self.probs is not None:
+            width = -(-(high - low + 1) // bins)
+            bins = -(-(high - low + 1) // width)
+            ranges = [(low + i * width, min(low + (i + 1) * width - 1, high)) for i in range(bins)]
         else:
-            side = min(max(side, 2), 10000)
+            width = (high - low) / bins
+            ranges = [(low + i * width, low + (i + 1) * width) for i in range(bins)]
+        values, probs = self._arrays()
+        if numpy:
+            indices = numpy.minimum(((values - low) // width).astype(numpy.int64), bins - 1)
+            totals = numpy.bincount(indices, weights=probs, minlength=bins).tolist()
+        else:
+            totals = [0.0] * bins
+            for value, p in zip(values, probs):
+                totals[min(int((value - low) // width), bins - 1)] += p
+        return [(start, end, p) for (start, end), p in zip(ranges, totals)]
 
-            def diceroll():
-                return randint(1, side)
+    def _arrays(self):
+        if self.probs is None:
+            values, probs = zip(*sorted(self.points.items()))
+        else:
+            values, probs = range(self.offset, self.offset + len(self.probs)), self.probs
+        if numpy:
+            return numpy.asarray(values, dtype=float), numpy.asarray(probs, dtype=float)
+        return values, probs
 
-        roll_a = [diceroll() for _ in range(num)]
-        roll_b = [diceroll() for _ in range(num)]
+    def at_least(self, target: float) -> float:
+        values, probs = self._arrays()
+        if numpy:
+            return float(probs[values >= target].sum())
+        return sum(p for value, p in zip(values, probs) if value >= target)
 
-        if reroll == Adv.a:
-            roll_a = roll_a if sum(roll_a) > sum(roll_b) else roll_b
-        elif reroll == Adv.d:
-            roll_a = roll_a if sum(roll_a) < sum(roll_b) else roll_b
+    def mean(self) -> float:
+        values, probs = self._arrays()
+        return float(numpy.dot(values, probs)) if numpy else sum(map(operator.mul, values, probs))
 
-        rolls.append(f"{num}d{side}{'a' if reroll == Adv.a else ('d' if reroll == Adv.d else '')} - {sum(roll_a):2d}"
-                     f" {roll_a}")
+    def stdev(self) -> float:
+        values, probs = self._arrays()
+        mean = self.mean()
+        if numpy:
+            return float(numpy.dot((values - mean) ** 2, probs)) ** 0.5
+        return sum((value - mean) ** 2 * p for value, p in zip(values, probs)) ** 0.5
 
-        stack.append(sum(roll_a))
+    def percentiles(self, *fractions: float) -> list:
+        """
+        :return: for each fraction, the lowest value whose cumulative probability reaches it
+        """
+        values, probs = self._arrays()
+        if numpy:
+            cdf = numpy.cumsum(probs)
+            indices = numpy.searchsorted(cdf, numpy.asarray(fractions) - 1e-9)
+            indices = numpy.minimum(indices, len(values) - 1).tolist()
+            if self.probs is None:
+                return [values[i].item() for i in indices]
+            return [self.offset + i for i in indices]
+        results = []
+        cdf = 0.0
+        i = 0
+        for fraction in fractions:
+            while i < len(values) - 1 and cdf + probs[i] < fraction - 1e-9:
+                cdf += probs[i]
+                i += 1
+            results.append(values[i])
+        return results
 
-    # evaluate using reverse polish notation rules
 
-    polish = rpn(roll_string)
+@lru_cache(maxsize=16)
+def distribution(expression: str) -> tuple:
+    """
+    Computes the exact outcome distributions of a roll expression, one per value it evaluates to. The work of every
+    operation is charged against one budget for the whole expression before it's done.
+    """
     stack = []
+    work = 0
+    for code, arg in compile_roll(expression).ops:
+        if code == PUSH:
+            stack.append(Distribution.point(arg))
+        elif code == BINARY:
+            x = stack.pop()
+            work += stack[-1].work(arg, x)
+            if work > max_work:
+                raise ValueError("Expression has too many possible outcomes to analyse.")
+            stack[-1] = arg(stack[-1], x)
+        elif code == NEG:
+            stack[-1] = -stack[-1]
+        else:
+            plan = Distribution.plan_dice(arg, stack.pop() if arg.counted else Distribution.point(1))
+            work += plan[-1]
+            if work > max_work:
+                raise ValueError("Expression has too many possible outcomes to analyse.")
+            stack.append(Distribution.dice(plan))
+    for dist in stack:
+        if dist.probs is not None:
+            total = sum(dist.probs)
+            dist.probs = dist.probs / total if numpy else [p / total for p in dist.probs]
+    return tuple(stack)
 
-    u_ops = {
-        '_': lambda: stack.append(-stack.pop())
-    }
 
-    b_ops = {
-        '+': lambda x, y: stack.append(y + x),
-        '-': lambda x, y: stack.append(y - x),
-        '/': lambda x, y: stack.append(y / x),
-        '*': lambda x, y: stack.append(y * x)
-    }
+def simulate(program: Program, trials: int) -> tuple:
+    """
+    Evaluates a program for many trials at once. With NumPy, the stack holds arrays of per-trial values, worked
+    through in chunks of trials to bound memory; without it, the trials are rolled one by one.
+    :return: the empirical outcome distribution of each value the expression evaluates to
+    """
+    if not numpy:
+        results = [run_program(program, log=False)[0] for _ in range(trials)]
+        return tuple(Distribution.from_samples(column) for column in zip(*results))
+    chunk = max(1, (1 << 22) // max(program.dice, 1))
+    parts = [simulate_chunk(program, min(chunk, trials - start)) for start in range(0, trials, chunk)]
+    return tuple(Distribution.from_samples(numpy.concatenate(column)) for column in zip(*parts))
 
-    while polish:
-        token = polish.pop(0)
-        if isinstance(token, (int, float)):
-            stack.append(token)
-        elif len(stack) > 1 and token in b_ops:
-            b_ops[token](stack.pop(), stack.pop())
-        elif len(stack) > 0 and token in u_ops:
-            u_ops[token]()
-        elif token[0] == 'd':
-            roll(token, stack)
 
-    return stack, rolls
+def simulate_chunk(program: Program, trials: int) -> list:
+    stack = []
+    with numpy.errstate(all='ignore'):
+        for code, arg in program.ops:
+            if code == PUSH:
+                stack.append(numpy.full(trials, float(arg)))
+            elif code == BINARY:
+                x = stack.pop()
+                if arg is operator.truediv and not x.all():
+                    raise ZeroDivisionError("division by zero is possible")
+                stack[-1] = arg(stack[-1], x)
+            elif code == NEG:
+                stack[-1] = -stack[-1]
+            else:
+                if arg.counted:
+                    counts = stack.pop()
+                    if not numpy.isfinite(counts).all():
+                        raise OverflowError("number of dice out of range")
+                    counts = numpy.clip(numpy.rint(counts), 1, 10000).astype(numpy.int64)
+                else:
+                    counts = numpy.ones(trials, numpy.int64)
+                stack.append(roll_pools(arg, counts))
+    return stack
+
+
+def roll_pools(dice: Dice, counts):
+    """
+    Rolls a pool of the given dice for each trial, drawing the dice of all trials at once.
+    :param counts: NumPy array of the number of dice in each trial
+    :return: NumPy array of the totals
+    """
+    sums = trial_pools(dice, counts)
+    if dice.adv != Adv.n:
+        other = trial_pools(dice, counts)
+        sums = numpy.maximum(sums, other) if dice.adv == Adv.a else numpy.minimum(sums, other)
+    return sums
+
+
+def trial_pools(dice: Dice, counts):
+    # every die is tagged with its trial, so that rerolls, explosions and selection work on all pools together
+    low, high = (-1, 1) if dice.sides == 'f' else (1, dice.sides)
+    owners = numpy.repeat(numpy.arange(len(counts)), counts)
+    values = rng.integers(low, high, size=len(owners), endpoint=True)
+    if dice.reroll:
+        redo = values <= dice.reroll
+        values[redo] = rng.integers(low, high, size=int(redo.sum()), endpoint=True)
+    if dice.explode:
+        origins = numpy.flatnonzero(values == high)
+        for _ in range(explode_depth):
+            if not len(origins):
+                break
+            batch = rng.integers(low, high, size=len(origins), endpoint=True)
+            values[origins] += batch
+            origins = origins[batch == high]
+    if dice.select:
+        # sort the dice of each trial, then keep them by their rank within the trial
+        if dice.select in ('kh', 'kl'):
+            keep = numpy.minimum(counts, dice.select_count)
+        else:
+            keep = numpy.maximum(counts - dice.select_count, 0)
+        values = values[numpy.lexsort((values, owners))]
+        rank = numpy.arange(len(values)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        kept = rank >= (counts - keep)[owners] if dice.select in ('kh', 'dl') else rank < keep[owners]
+        values, owners = values[kept], owners[kept]
+    return numpy.bincount(owners, weights=values, minlength=len(counts))
 
 
 class DiceRoll(BasePlugin):
@@ -148,6 +912,17 @@ class DiceRoll(BasePlugin):
     description = "A plugin for rolling dice and dice accessories."
     version = "1.0"
     author = "GTG3000"
+    default_config = {
+        "max_tokens": 500,
+        "max_depth": 100,
+        "max_dice": 1000000,
+        "max_trials": 1000000,
+        "max_batch": 100,
+        # total dice a simulation may roll over all of its trials
+        "max_simulated_dice": 100000000,
+        # expressions that may roll more dice than this are evaluated in a worker thread
+        "offload_dice": 20000
+    }
 
     @Command("Roll",
              doc="Rolls a specified amount of specified dice with specified bonus and advantage/disadvantage.\n\n"
@@ -155,17 +930,37 @@ class DiceRoll(BasePlugin):
                  "subtraction, multiplication and division.\n"
                  "It is also capable of doing multiple rolls per same expression, '4df 4df' for example.\n"
                  "'dn' is treated as an unary operator, so for example '2d6 d6' will roll 2d6 and then roll that "
-                 "amount of d6.",
-             syntax="[number]D(die/F)[A/D][+/-bonus]",
+                 "amount of d6.\n"
+                 "Numbered dice take modifiers after the die: 'r1' rerolls dice showing 1 or lower once, '!' rolls "
+                 "dice showing their highest side again and adds the result, up to 20 times in a row, and 'kh3', "
+                 "'kl3', 'dh3' and 'dl3' keep or drop the 3 highest or lowest dice, as in '4d6kh3'.\n"
+                 "With xN, such as 'x6 1d20+2', the expression is rolled N times. Several expressions can be "
+                 "separated with ';'. Batches are shown as one table, with the lowest, highest and mean result of "
+                 "each expression.\n"
+                 "With -l/--log, the complete log of rolled dice is attached as a compressed text file.\n"
+                 "With -s/--simulate, rolls the expression the given number of times and shows the spread of the "
+                 "results.",
+             syntax="[-l/--log] [-s/--simulate trials] [xN] [number]D(die/F)[R(n)][!][KH/KL/DH/DL(n)][A/D][+/-bonus]",
              category="role_play",
              run_anywhere=True)
     async def _roll(self, msg):
         args = msg.clean_content.split(None, 1)
         if len(args) < 2:
             raise CommandSyntaxError("Requires a roll expression.")
+        if args[1].lower().startswith(("--simulate ", "-s ")):
+            await self._simulate(msg, args[1])
+            return
+        if batch_prefix.match(args[1]) or ';' in args[1]:
+            await self._batch(msg, args[1])
+            return
+        expression = args[1]
+        full_log = expression.lower().startswith(("--log ", "-l "))
+        if full_log:
+            expression = expression.split(None, 1)[1]
 
-        results, rolls = parse_roll(args[1])
-        roll_args = ' '.join(roll_tokens.findall(args[1])).upper()
+        program = compile_roll(expression)
+        results, rolls = await self._run(program)
+        roll_args = program.expression.upper()
 
         results = (str(x) for x in results)
 
@@ -173,16 +968,181 @@ class DiceRoll(BasePlugin):
             t_string = f"**ANALYSIS: {msg.author.display_name} has attempted a " \
                        f"{roll_args} roll, getting {', '.join(results)}.\n" \
                        f"ANALYSIS: Rolled dice:** ```\n"
-            if len(rolls[0]) + len(t_string) <= 1996:
-                for r in rolls:
-                    if len(t_string) + len(r) > 1996:
-                        t_string += r[:1993 - len(t_string)] + '...'
-                        break
-                    else:
-                        t_string += r + '\n'
-                t_string += '```'
+            # only as much of the log is formatted as fits into the message
+            for piece in roll_log(rolls):
+                if len(t_string) + len(piece) > 1993:
+                    t_string += piece[:1993 - len(t_string)] + '...\n'
+                    break
+                t_string += piece
+            t_string += '```'
+            if full_log:
+                _file = await asyncio.get_running_loop().run_in_executor(None, compress_log, rolls)
+                await respond(msg, t_string, file=File(_file, filename="rolls.txt.gz"))
             else:
-                t_string += rolls[0][:1990 - len(t_string)] + '...\n```'
-            await respond(msg, t_string)
+                await respond(msg, t_string)
         else:
             await respond(msg, f"**ANALYSIS: expression {roll_args} evaluated. Result: {', '.join(results)}**")
+
+    @Command("RollStats", "RollOdds",
+             doc="Calculates the exact outcome distribution of a roll expression, as understood by Roll: mean, "
+                 "standard deviation, range and percentiles of the result, and the chance to get at least the "
+                 "target, if one is given.",
+             syntax="(expression) [>= target]",
+             category="role_play",
+             run_anywhere=True)
+    async def _rollstats(self, msg):
+        args = msg.clean_content.split(None, 1)
+        if len(args) < 2:
+            raise CommandSyntaxError("Requires a roll expression.")
+        expression, _, target = args[1].partition(">=")
+        try:
+            target = float(target) if target.strip() else None
+        except ValueError:
+            raise CommandSyntaxError("Target must be a number.")
+
+        program = compile_roll(expression)
+        if not program.ops:
+            raise CommandSyntaxError("Requires a roll expression.")
+        self._check_budget(program, rolling=False)
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(None, distribution, program.expression)
+        except ValueError as e:
+            raise CommandSyntaxError(e)
+        except (ZeroDivisionError, OverflowError) as e:
+            raise CommandSyntaxError(f"Expression can't be analysed: {e}.")
+
+        t_string = f"**ANALYSIS: Outcome distribution of {program.expression.upper()}:** ```\n"
+        for i, dist in enumerate(results, 1):
+            if len(results) > 1:
+                t_string += f"Result {i}:\n"
+            t_string += self._describe(dist, target)
+        await respond(msg, t_string[:1990] + "```")
+
+    # Utilities
+
+    @staticmethod
+    def _describe(dist: Distribution, target: float = None, histogram: bool = False) -> str:
+        """
+        Summarises a distribution in a few lines of text, for a code block.
+        """
+        num = format_number
+        low, high = dist.bounds()
+        percentiles = dist.percentiles(0.05, 0.25, 0.5, 0.75, 0.95)
+        t_string = f"Mean {num(dist.mean())}, standard deviation {num(dist.stdev())}, range {num(low)} to " \
+                   f"{num(high)}\n" \
+                   f"5%: {num(percentiles[0])} | 25%: {num(percentiles[1])} | 50%: {num(percentiles[2])} | " \
+                   f"75%: {num(percentiles[3])} | 95%: {num(percentiles[4])}\n"
+        if target is not None:
+            t_string += f"Chance of at least {num(target)}: {num(dist.at_least(target) * 100)}%\n"
+        if histogram:
+            bins = dist.histogram()
+            labels = [num(start) if start == end else f"{num(start)} - {num(end)}" for start, end, _ in bins]
+            width = max(len(label) for label in labels)
+            peak = max(p for _, _, p in bins)
+            for label, (_, _, p) in zip(labels, bins):
+                t_string += f"{label:>{width}} | {'#' * round(p / peak * 25):25} {num(p * 100)}%\n"
+        return t_string
+
+    async def _batch(self, msg, args: str):
+        match = batch_prefix.match(args)
+        times = int(match.group(1)) if match else 1
+        if not 0 < times <= self.plugin_config['max_batch']:
+            raise CommandSyntaxError(f"Number of rolls must be between 1 and {self.plugin_config['max_batch']}.")
+        programs = [compile_roll(expression) for expression in args[match.end() if match else 0:].split(';')]
+        programs = [program for program in programs if program.ops]
+        if not programs:
+            raise CommandSyntaxError("Requires a roll expression.")
+        for program in programs:
+            self._check_budget(program)
+        dice = sum(program.dice for program in programs) * times
+        if dice > self.plugin_config['max_dice']:
+            raise CommandSyntaxError(f"Rolls may roll up to {dice} dice, the limit is "
+                                     f"{self.plugin_config['max_dice']}.")
+        try:
+            if dice > self.plugin_config['offload_dice']:
+                columns = await asyncio.get_running_loop().run_in_executor(None, run_batch, programs, times)
+            else:
+                columns = run_batch(programs, times)
+        except (ZeroDivisionError, OverflowError) as e:
+            raise CommandSyntaxError(f"Expression can't be evaluated: {e}.")
+
+        # one column per expression and one row per roll, then the statistics of the first value of each roll
+        headers = ["#"] + [program.expression.upper() for program in programs]
+        rows = [[str(i)] + [", ".join(format_number(x) for x in column[i - 1]) for column in columns]
+                for i in range(1, times + 1)]
+        firsts = [[values[0] for values in column if values] for column in columns]
+        for name, func in (("min", min), ("max", max), ("mean", mean)):
+            rows.append([name] + [format_number(func(values)) if values else "-" for values in firsts])
+        widths = [max(len(row[i]) for row in rows + [headers]) for i in range(len(headers))]
+
+        t_string = f"**ANALYSIS: {msg.author.display_name} has rolled:** ```\n"
+        lines = [" | ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip() for row in [headers] + rows]
+        if sum(len(line) + 1 for line in lines) + len(t_string) > 1996:
+            # the summary rows are kept, the individual rolls are cut short
+            summary = lines[-3:]
+            budget = 1990 - len(t_string) - sum(len(line) + 1 for line in summary)
+            kept = []
+            for line in lines[:-3]:
+                budget -= len(line) + 1
+                if budget < 0:
+                    break
+                kept.append(line)
+            lines = kept + ["..."] + summary
+        t_string += "\n".join(lines)[:1996 - len(t_string)] + "```"
+        await respond(msg, t_string)
+
+    async def _simulate(self, msg, args: str):
+        try:
+            _, trials, expression = args.split(None, 2)
+            trials = int(trials)
+        except ValueError:
+            raise CommandSyntaxError("Simulation requires a number of trials and a roll expression.")
+        if not 0 < trials <= self.plugin_config['max_trials']:
+            raise CommandSyntaxError(f"Number of trials must be between 1 and {self.plugin_config['max_trials']}.")
+
+        program = compile_roll(expression)
+        if not program.ops:
+            raise CommandSyntaxError("Requires a roll expression.")
+        self._check_budget(program)
+        # rolling without NumPy is about a hundred times slower
+        budget = self.plugin_config['max_simulated_dice'] // (1 if numpy else 100)
+        if trials * max(program.dice, 1) > budget:
+            raise CommandSyntaxError(f"Simulation may roll up to {trials * max(program.dice, 1)} dice, the limit is "
+                                     f"{budget}.")
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(None, simulate, program, trials)
+        except (ZeroDivisionError, OverflowError) as e:
+            raise CommandSyntaxError(f"Expression can't be evaluated: {e}.")
+
+        t_string = f"**ANALYSIS: Simulated {trials} rolls of {program.expression.upper()}:** ```\n"
+        for i, dist in enumerate(results, 1):
+            if len(results) > 1:
+                t_string += f"Result {i}:\n"
+            t_string += self._describe(dist, histogram=True)
+        await respond(msg, t_string[:1990] + "```")
+
+    def _check_budget(self, program: Program, rolling: bool = True):
+        """
+        Rejects expressions that could take too long to evaluate, before anything is rolled.
+        :param rolling: whether the expression is going to be rolled, rather than analysed
+        """
+        if program.tokens > self.plugin_config['max_tokens']:
+            raise CommandSyntaxError(f"Expression is too long, the limit is {self.plugin_config['max_tokens']} "
+                                     f"tokens.")
+        if program.depth > self.plugin_config['max_depth']:
+            raise CommandSyntaxError(f"Expression has more than {self.plugin_config['max_depth']} separate values.")
+        if rolling and program.dice > self.plugin_config['max_dice']:
+            raise CommandSyntaxError(f"Expression may roll up to {program.dice} dice, the limit is "
+                                     f"{self.plugin_config['max_dice']}.")
+
+    async def _run(self, program: Program):
+        """
+        Evaluates a program within the budget, in a worker thread if it may roll many dice.
+        """
+        self._check_budget(program)
+        try:
+            if program.dice > self.plugin_config['offload_dice']:
+                return await asyncio.get_running_loop().run_in_executor(None, run_program, program)
+            return run_program(program)
+        except (ZeroDivisionError, OverflowError) as e:
+            raise CommandSyntaxError(f"Expression can't be evaluated: {e}.")
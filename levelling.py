@@ -1,84 +1,1068 @@
 from red_star.plugin_manager import BasePlugin
-from red_star.rs_utils import respond, find_user, is_positive, JsonFileDict, group_items
+from red_star.rs_utils import respond, find_user, find_role, is_positive, group_items
 from red_star.command_dispatcher import Command
 from red_star.rs_errors import CommandSyntaxError
-from discord.errors import Forbidden
+from discord import File, Object, Message, Reaction
+from discord.errors import Forbidden, HTTPException, NotFound
+from discord.utils import snowflake_time, time_snowflake, utcnow
+from pathlib import Path
+from time import time
+from datetime import timedelta
+from bisect import bisect_left, bisect_right
+from itertools import chain, islice
+from math import isfinite, log2
+from array import array
+from copy import deepcopy
+from tempfile import TemporaryFile
+import asyncio
+import csv
+import json
+import os
+import sqlite3
+
+
+def write_atomic(path: Path, data):
+    """
+    Writes data as JSON into a temporary file next to the target and renames it over the target, so that a crash
+    mid-write can never leave a truncated XP file behind.
+    :param path: the file to write
+    :param data: JSON-serializable data
+    """
+    tmp = path.with_name(path.name + ".tmp")
+    with tmp.open("w", encoding="utf-8") as fp:
+        json.dump(data, fp)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp, path)
+
+
+def export_xp(records, fmt: str):
+    """
+    Writes XP records into a temporary file as CSV or JSONL, a chunk of rows at a time, so the whole export is never
+    held in memory as one string.
+    :param records: iterable of (member ID, xp, last activity) triples
+    :param fmt: "csv" or "jsonl"
+    :return: the file, rewound to the start
+    """
+    fp = TemporaryFile()
+    if fmt == "csv":
+        fp.write(b"member,xp,seen\n")
+        line = "{},{},{}\n".format
+    else:
+        line = '{{"member": "{}", "xp": {}, "seen": {}}}\n'.format
+    records = iter(records)
+    while True:
+        chunk = list(islice(records, 5000))
+        if not chunk:
+            break
+        fp.write("".join(line(*record) for record in chunk).encode("utf-8"))
+    fp.seek(0)
+    return fp
+
+
+def import_xp(fp, fmt: str):
+    """
+    Parses XP records from an uploaded CSV or JSONL file line by line.
+    :param fp: binary file object
+    :param fmt: "csv" or "jsonl"
+    :return: generator of (member ID, xp, last activity) triples
+    """
+    lines = (line.decode("utf-8-sig") for line in fp)
+    rows = csv.reader(lines) if fmt == "csv" else lines
+    for num, row in enumerate(rows, 1):
+        if not row or fmt != "csv" and not row.strip():
+            continue
+        try:
+            if fmt == "csv":
+                if num == 1 and not row[0].strip().isdecimal():
+                    continue  # header
+                uid, xp, seen = int(row[0]), int(row[1]), int(row[2]) if len(row) > 2 and row[2].strip() else 0
+            else:
+                row = json.loads(row)
+                uid, xp, seen = int(row["member"]), int(row["xp"]), int(row.get("seen", 0))
+        except (ValueError, IndexError, KeyError, TypeError, AttributeError):
+            raise ValueError(f"Malformed record on line {num}.")
+        if not 0 < uid < 2 ** 64 or not -2 ** 63 <= xp < 2 ** 63:
+            raise ValueError(f"Value out of range on line {num}.")
+        yield uid, xp, min(max(seen, 0), 2 ** 32 - 1)
+
+
+class JsonXPStore:
+    """
+    Storage backend keeping the XP table of every guild in its own JSON file, rewritten whole on save.
+    Last activity times and weekly/monthly buckets are kept in separate <guild>.seen.json and <guild>.periods.json,
+    leaving the XP files in the usual format.
+    """
+
+    def __init__(self, folder: Path):
+        self.folder = folder
+        self.folder.mkdir(parents=True, exist_ok=True)
+
+    def guilds(self) -> list:
+        return [path.stem for path in self.folder.glob("*.json") if path.stem.isdecimal()]
+
+    def _load(self, name: str) -> dict:
+        try:
+            with (self.folder / name).open(encoding="utf-8") as fp:
+                return json.load(fp)
+        except FileNotFoundError:
+            return {}
+
+    def load(self, gid: str) -> tuple:
+        return self._load(f"{gid}.json"), self._load(f"{gid}.seen.json"), self._load(f"{gid}.periods.json")
+
+    @staticmethod
+    def snapshot(table: "XPTable", members: set, reset: bool):
+        # only copies of the arrays are taken on the event loop, the dicts are built in the worker thread
+        return table.records(), table.periods.copy()
+
+    def write(self, gid: str, data: tuple):
+        records, periods = data
+        xp = {}
+        seen = {}
+        for uid, member_xp, member_seen in records:
+            xp[str(uid)] = member_xp
+            seen[str(uid)] = member_seen
+        write_atomic(self.folder / f"{gid}.json", xp)
+        write_atomic(self.folder / f"{gid}.seen.json", seen)
+        write_atomic(self.folder / f"{gid}.periods.json", periods.to_json())
+
+    def close(self):
+        pass
+
+
+class SqliteXPStore:
+    """
+    Storage backend keeping XP tables in an SQLite database in WAL mode, purely for persistence: tables are loaded
+    whole and ranked in memory. Only records changed since the last save are written, as one batch of upserts per
+    guild. The weekly/monthly buckets of each recently active member are a row of their own, written along with the
+    XP record and deleted once the buckets expire.
+    """
+
+    def __init__(self, path: Path):
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS xp (guild INTEGER NOT NULL, member INTEGER NOT NULL, "
+                             "xp INTEGER NOT NULL, seen INTEGER NOT NULL DEFAULT 0, "
+                             "PRIMARY KEY (guild, member)) WITHOUT ROWID")
+            if "seen" not in {row[1] for row in self._db.execute("PRAGMA table_info(xp)")}:
+                self._db.execute("ALTER TABLE xp ADD COLUMN seen INTEGER NOT NULL DEFAULT 0")
+            # leaderboards are served from the in-memory rank index, so an index on XP would only slow down writes
+            self._db.execute("DROP INDEX IF EXISTS xp_rank")
+            # day and week are the latest ones the buckets count, so expired rows can be found without parsing them
+            self._db.execute("CREATE TABLE IF NOT EXISTS xp_buckets (guild INTEGER NOT NULL, member INTEGER NOT NULL, "
+                             "day INTEGER NOT NULL, week INTEGER NOT NULL, buckets TEXT NOT NULL, "
+                             "PRIMARY KEY (guild, member)) WITHOUT ROWID")
+            if self._db.execute("SELECT 1 FROM sqlite_master WHERE name = 'xp_periods'").fetchone():
+                # buckets used to be stored as one JSON document per guild
+                for guild, buckets in self._db.execute("SELECT guild, buckets FROM xp_periods").fetchall():
+                    self._write_buckets(guild, ((int(uid), array('q', b)) for uid, b in json.loads(buckets).items()))
+                self._db.execute("DROP TABLE xp_periods")
+
+    def empty(self) -> bool:
+        return self._db.execute("SELECT 1 FROM xp LIMIT 1").fetchone() is None
+
+    def migrated(self) -> bool:
+        """
+        Whether the JSON tables were already copied over, so that emptying the tables doesn't bring them back.
+        """
+        return self._db.execute("PRAGMA user_version").fetchone()[0] >= 1
+
+    def mark_migrated(self):
+        with self._db:
+            self._db.execute("PRAGMA user_version = 1")
+
+    def guilds(self) -> list:
+        return [str(gid) for gid, in self._db.execute("SELECT DISTINCT guild FROM xp")]
+
+    def load(self, gid: str) -> tuple:
+        xp = {}
+        seen = {}
+        for member, member_xp, member_seen in self._db.execute("SELECT member, xp, seen FROM xp WHERE guild = ?",
+                                                               (int(gid),)):
+            xp[member] = member_xp
+            seen[member] = member_seen
+        periods = {member: json.loads(buckets) for member, buckets in
+                   self._db.execute("SELECT member, buckets FROM xp_buckets WHERE guild = ?", (int(gid),))}
+        return xp, seen, periods
+
+    @staticmethod
+    def snapshot(table: "XPTable", members: set, reset: bool):
+        # the buckets are only copied here, and turned into JSON in the worker thread
+        buckets = table.periods.members() if reset else members
+        if reset:
+            members = table.members()
+        return reset, [(uid, table.record(uid)) for uid in members], \
+            [(uid, table.periods.buckets(uid)) for uid in buckets]
+
+    def _write_buckets(self, guild: int, rows):
+        self._db.executemany("INSERT INTO xp_buckets (guild, member, day, week, buckets) VALUES (?, ?, ?, ?, ?) "
+                             "ON CONFLICT (guild, member) DO UPDATE SET day = excluded.day, week = excluded.week, "
+                             "buckets = excluded.buckets",
+                             [(guild, int(uid), *XPPeriods.latest(buckets), json.dumps(buckets.tolist()))
+                              for uid, buckets in rows if buckets is not None])
+
+    def write(self, gid: str, data: tuple):
+        reset, rows, buckets = data
+        guild = int(gid)
+        first_day, first_week = XPPeriods.cutoff()
+        with self._db:
+            if reset:
+                self._db.execute("DELETE FROM xp WHERE guild = ?", (guild,))
+                self._db.execute("DELETE FROM xp_buckets WHERE guild = ?", (guild,))
+            self._db.executemany("INSERT INTO xp (guild, member, xp, seen) VALUES (?, ?, ?, ?) "
+                                 "ON CONFLICT (guild, member) DO UPDATE SET xp = excluded.xp, seen = excluded.seen",
+                                 [(guild, int(uid), *record) for uid, record in rows if record is not None])
+            self._db.executemany("DELETE FROM xp WHERE guild = ? AND member = ?",
+                                 [(guild, int(uid)) for uid, record in rows if record is None])
+            self._write_buckets(guild, buckets)
+            self._db.executemany("DELETE FROM xp_buckets WHERE guild = ? AND member = ?",
+                                 [(guild, int(uid)) for uid, member_buckets in buckets if member_buckets is None])
+            self._db.execute("DELETE FROM xp_buckets WHERE guild = ? AND day <= ? AND week <= ?",
+                             (guild, first_day, first_week))
+
+    def close(self):
+        self._db.close()
+
+
+def calc_xp(length: int, cfg: dict, multiplier: float = 1.0) -> int:
+    """
+    Calculates the XP awarded for a message of given length, scaling linearly from xp_min at low_cutoff to xp_max at
+    the message length limit.
+    :param length: length of the message text
+    :param cfg: guild XP settings
+    :param multiplier: channel XP multiplier
+    :return:
+    """
+    if length < cfg["low_cutoff"]:
+        return 0
+
+    t_percent = (length - cfg["low_cutoff"]) / max(2000 - cfg["low_cutoff"], 1)
+
+    t_xp = cfg["xp_min"] + (cfg["xp_max"] - cfg["xp_min"]) * t_percent
+
+    return int(t_xp * multiplier)
+
+
+class XPRules:
+    """
+    The XP settings of a guild compiled for the message path: XP per message length is precalculated for every
+    length up to the message limit (per channel, if the channel has a multiplier), and the channels excluded from XP
+    are resolved into a set of IDs. Level thresholds and role rewards are turned into sorted tables for bisecting.
+    Rebuilt whenever the settings change.
+    """
+
+    __slots__ = ("cfg", "award", "channel_award", "multipliers", "excluded", "thresholds", "reward_levels",
+                 "reward_roles", "cooldown")
+
+    max_length = 2000
+    max_level = 1000
+
+    def __init__(self, cfg: dict, excluded=()):
+        self.cfg = cfg
+        self.multipliers = {int(cid): mult for cid, mult in cfg.get("multipliers", {}).items()}
+        self.award = self._compile(1.0)
+        self.channel_award = {cid: self._compile(mult) for cid, mult in self.multipliers.items()}
+        self.excluded = frozenset(excluded)
+        self.cooldown = max(cfg.get("cooldown", 0), 0)
+        # every level costs level_xp more than the one before it
+        level_xp = max(cfg.get("level_xp", 100), 1)
+        self.thresholds = array('q', (level_xp * n * (n + 1) // 2 for n in range(1, self.max_level + 1)))
+        rewards = sorted((int(level), int(role)) for level, role in cfg.get("level_roles", {}).items())
+        self.reward_levels = [level for level, _ in rewards]
+        self.reward_roles = [role for _, role in rewards]
+
+    def _compile(self, multiplier: float) -> array:
+        return array('q', (calc_xp(i, self.cfg, multiplier) for i in range(self.max_length + 1)))
+
+    def xp(self, channel_id: int, length: int) -> int:
+        if length > self.max_length:
+            # mentions can make the cleaned-up text longer than the limit
+            return calc_xp(length, self.cfg, self.multipliers.get(channel_id, 1.0))
+        return self.channel_award.get(channel_id, self.award)[length]
+
+    def level(self, xp: int) -> int:
+        return bisect_right(self.thresholds, xp)
+
+    def reward_tier(self, xp: int) -> int:
+        """
+        Returns the amount of reward roles earned with the given XP.
+        """
+        return bisect_right(self.reward_levels, self.level(xp))
+
+
+class RankIndex:
+    """
+    A sorted list of (key, member ID) pairs split into buckets of bounded size, each bucket being a pair of parallel
+    arrays, with a Fenwick tree over the bucket sizes.
+    Adding and removing pairs costs O(log n + load), finding the position of a pair O(log n) and walking the first k
+    pairs O(k), so leaderboards don't need a full sort of the guild every time.
+    """
+
+    _load = 512  # buckets are split once they grow past twice this size
+
+    def __init__(self, pairs=(), typecode: str = 'q'):
+        pairs = sorted(pairs)
+        self._typecode = typecode
+        self._len = len(pairs)
+        self._keys = []
+        self._uids = []
+        for i in range(0, len(pairs), self._load):
+            chunk = pairs[i:i + self._load]
+            self._keys.append(array(typecode, (key for key, _ in chunk)))
+            self._uids.append(array('Q', (uid for _, uid in chunk)))
+        self._maxes = [(keys[-1], uids[-1]) for keys, uids in zip(self._keys, self._uids)]
+        self._build_tree()
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        for keys, uids in zip(self._keys, self._uids):
+            yield from zip(keys, uids)
+
+    def _build_tree(self):
+        tree = [0] * (len(self._keys) + 1)
+        for i, keys in enumerate(self._keys, 1):
+            tree[i] += len(keys)
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def _tree_add(self, pos: int, delta: int):
+        pos += 1
+        while pos < len(self._tree):
+            self._tree[pos] += delta
+            pos += pos & -pos
+
+    def _tree_prefix(self, pos: int) -> int:
+        # total amount of pairs in buckets before pos
+        total = 0
+        while pos > 0:
+            total += self._tree[pos]
+            pos -= pos & -pos
+        return total
+
+    def _locate(self, pos: int, key, uid: int) -> int:
+        # position of the pair within bucket pos: bisect the keys, then the member IDs among equal keys
+        keys = self._keys[pos]
+        lo = bisect_left(keys, key)
+        return bisect_left(self._uids[pos], uid, lo, bisect_right(keys, key, lo))
+
+    def add(self, key, uid: int):
+        self._len += 1
+        if not self._keys:
+            self._keys.append(array(self._typecode, (key,)))
+            self._uids.append(array('Q', (uid,)))
+            self._maxes.append((key, uid))
+            self._build_tree()
+            return
+        pos = bisect_left(self._maxes, (key, uid))
+        if pos == len(self._maxes):
+            pos -= 1
+            self._keys[pos].append(key)
+            self._uids[pos].append(uid)
+            self._maxes[pos] = (key, uid)
+        else:
+            i = self._locate(pos, key, uid)
+            self._keys[pos].insert(i, key)
+            self._uids[pos].insert(i, uid)
+        keys, uids = self._keys[pos], self._uids[pos]
+        if len(keys) > self._load * 2:
+            self._keys[pos:pos + 1] = [keys[:self._load], keys[self._load:]]
+            self._uids[pos:pos + 1] = [uids[:self._load], uids[self._load:]]
+            self._maxes[pos:pos + 1] = [(keys[self._load - 1], uids[self._load - 1]), (keys[-1], uids[-1])]
+            self._build_tree()
+        else:
+            self._tree_add(pos, 1)
+
+    def remove(self, key, uid: int):
+        pos = bisect_left(self._maxes, (key, uid))
+        if pos == len(self._maxes):
+            raise KeyError(uid)
+        keys, uids = self._keys[pos], self._uids[pos]
+        i = self._locate(pos, key, uid)
+        if i == len(keys) or keys[i] != key or uids[i] != uid:
+            raise KeyError(uid)
+        del keys[i]
+        del uids[i]
+        self._len -= 1
+        if keys:
+            self._maxes[pos] = (keys[-1], uids[-1])
+            self._tree_add(pos, -1)
+        else:
+            del self._keys[pos]
+            del self._uids[pos]
+            del self._maxes[pos]
+            self._build_tree()
+
+    def index(self, key, uid: int) -> int:
+        """
+        Returns the amount of pairs sorted before the given one.
+        """
+        pos = bisect_left(self._maxes, (key, uid))
+        if pos == len(self._maxes):
+            return self._len
+        return self._tree_prefix(pos) + self._locate(pos, key, uid)
+
+
+class XPPeriods:
+    """
+    Rolling XP totals of a guild's recently active members, for weekly and monthly leaderboards.
+    Every member has a ring of daily buckets covering the last week and a ring of weekly buckets covering the current
+    week and the four before it, each bucket tagged with the day or week it counts. Buckets are recycled in place
+    once their day or week has passed, and members with nothing but expired buckets are dropped, so the size only
+    depends on the amount of recently active members.
+    """
+
+    days = 7
+    weeks = 5
+    # bucket layout: daily XP, daily tags, weekly XP, weekly tags
+    _day_tags = days
+    _week_xp = days * 2
+    _week_tags = days * 2 + weeks
+    _size = (days + weeks) * 2
+
+    def __init__(self, data: dict = None):
+        self._buckets = {int(uid): array('q', buckets) for uid, buckets in (data or {}).items()}
+
+    def __len__(self):
+        return len(self._buckets)
+
+    @staticmethod
+    def _day(when: float) -> int:
+        return int(when // 86400)
+
+    @staticmethod
+    def _week(day: int) -> int:
+        # day 0 of the epoch is a Thursday, so this makes weeks start on Monday
+        return (day + 3) // 7
+
+    @classmethod
+    def cutoff(cls) -> tuple:
+        """
+        :return: the last day and week that are no longer tracked
+        """
+        today = cls._day(time())
+        return today - cls.days, cls._week(today) - cls.weeks
+
+    @classmethod
+    def latest(cls, buckets: array) -> tuple:
+        """
+        :return: the latest day and week the buckets count
+        """
+        return max(buckets[cls._day_tags:cls._week_xp]), max(buckets[cls._week_tags:])
+
+    def members(self) -> list:
+        return list(self._buckets)
+
+    def buckets(self, uid: int):
+        """
+        Returns a copy of the buckets of the member, or None.
+        """
+        buckets = self._buckets.get(uid)
+        return buckets[:] if buckets is not None else None
+
+    def pop(self, uid: int):
+        self._buckets.pop(uid, None)
+
+    def add(self, uid: int, xp: int, when: float):
+        """
+        Adds XP to the buckets of the day and week the XP was earned at, if they're still tracked.
+        """
+        today = self._day(time())
+        day = self._day(when)
+        week = self._week(day)
+        in_week = today - self.days < day <= today
+        in_month = self._week(today) - self.weeks < week <= self._week(today)
+        if not (in_week or in_month) or not xp:
+            return
+        buckets = self._buckets.get(uid)
+        if buckets is None:
+            if xp < 0:
+                return
+            buckets = self._buckets[uid] = array('q', bytes(8 * self._size))
+        if in_week:
+            slot = day % self.days
+            if buckets[self._day_tags + slot] != day:
+                buckets[slot] = 0
+                buckets[self._day_tags + slot] = day
+            buckets[slot] += xp
+        if in_month:
+            slot = week % self.weeks
+            if buckets[self._week_tags + slot] != week:
+                buckets[self._week_xp + slot] = 0
+                buckets[self._week_tags + slot] = week
+            buckets[self._week_xp + slot] += xp
+
+    def _total(self, buckets: array, monthly: bool, today: int) -> int:
+        if monthly:
+            first = self._week(today) - self.weeks
+            return sum(buckets[self._week_xp + i] for i in range(self.weeks) if buckets[self._week_tags + i] > first)
+        first = today - self.days
+        return sum(buckets[i] for i in range(self.days) if buckets[self._day_tags + i] > first)
+
+    def total(self, uid: int, monthly: bool = False) -> int:
+        buckets = self._buckets.get(uid)
+        return self._total(buckets, monthly, self._day(time())) if buckets else 0
+
+    def top(self, monthly: bool = False) -> list:
+        """
+        Returns (member ID, xp) pairs of everyone with XP in the period, from highest XP to lowest.
+        """
+        today = self._day(time())
+        totals = ((uid, self._total(buckets, monthly, today)) for uid, buckets in self._buckets.items())
+        return sorted(((uid, xp) for uid, xp in totals if xp > 0), key=lambda x: (-x[1], x[0]))
+
+    def prune(self):
+        first_day, first_week = self.cutoff()
+        for uid in [uid for uid, buckets in self._buckets.items()
+                    if max(buckets[self._day_tags:self._week_xp]) <= first_day
+                    and max(buckets[self._week_tags:]) <= first_week]:
+            del self._buckets[uid]
+
+    def copy(self) -> "XPPeriods":
+        periods = XPPeriods()
+        periods._buckets = {uid: buckets[:] for uid, buckets in self._buckets.items()}
+        return periods
+
+    def to_json(self) -> dict:
+        return {str(uid): buckets.tolist() for uid, buckets in self._buckets.items()}
+
+
+class XPTable:
+    """
+    The XP table of a single guild, mapping member IDs to XP and the time they were last active.
+    Member IDs, XP and activity times are kept in sorted parallel arrays, which takes a fraction of the memory of a
+    dict on large guilds. New members go into a small buffer that is merged into the arrays once it grows, so inserts
+    don't shift the arrays every time. A rank index of (key, member ID) is kept in sync with every change.
+
+    With a half-life set, XP decays over time. Decay is never applied in bulk: the stored XP is only brought up to
+    date when the record is written, and reads calculate the decayed value from the last activity time. The rank key
+    log2(xp) + seen/half-life orders members the same as their decayed XP at any moment, so the index never needs
+    updating as time passes. A last activity time of 0 means unknown (records from before activity was tracked), and
+    such records are stamped with the current time once decay is on, rather than decayed from 1970.
+    """
+
+    def __init__(self, data: dict = None, seen: dict = None, half_life: float = 0, periods: dict = None):
+        seen = seen or {}
+        self._load(((int(uid), int(xp), int(seen.get(uid, 0))) for uid, xp in (data or {}).items()),
+                   half_life, periods)
+
+    @classmethod
+    def from_records(cls, records, half_life: float = 0, periods: dict = None) -> "XPTable":
+        """
+        Builds a table from (member ID, xp, last activity) triples, later duplicates replacing earlier ones.
+        """
+        table = cls.__new__(cls)
+        table._load(records, half_life, periods)
+        return table
+
+    def _load(self, records, half_life: float, periods: dict):
+        self.periods = XPPeriods(periods)
+        # the sort is stable, so of duplicate members the last one ends up last
+        items = sorted(records, key=lambda record: record[0])
+        items = [record for i, record in enumerate(items, 1) if i == len(items) or items[i][0] != record[0]]
+        self._ids = array('Q', (uid for uid, _, _ in items))
+        self._xp = array('q', (xp for _, xp, _ in items))
+        self._seen = array('I', (seen for _, _, seen in items))
+        self._new = {}  # members not yet merged into the arrays, self._new[uid]: [xp, seen]
+        self._period = half_life * 86400
+        self.stamped = self._stamp_unknown()
+        self._rank = self._build_rank()
+
+    def _stamp_unknown(self) -> int:
+        """
+        With decay on, sets the last activity of records without one to the current time.
+        :return: the amount of records stamped
+        """
+        if not self._period:
+            return 0
+        now = int(time())
+        count = 0
+        for i, seen in enumerate(self._seen):
+            if not seen:
+                self._seen[i] = now
+                count += 1
+        for record in self._new.values():
+            if not record[1]:
+                record[1] = now
+                count += 1
+        return count
+
+    def _build_rank(self) -> RankIndex:
+        return RankIndex(((self._key(xp, seen), uid) for uid, (xp, seen) in self._records()),
+                         'd' if self._period else 'q')
+
+    def _key(self, xp: int, seen: int):
+        if not self._period:
+            return -xp
+        if xp <= 0:
+            return float('inf')
+        return -(log2(xp) + seen / self._period)
+
+    def _decayed(self, xp: int, seen: int, now: int) -> int:
+        if not self._period or xp <= 0:
+            return xp
+        return round(xp * 2 ** ((seen - now) / self._period))
+
+    def _records(self):
+        return chain(zip(self._ids, zip(self._xp, self._seen)), ((uid, tuple(r)) for uid, r in self._new.items()))
+
+    def records(self):
+        """
+        Iterates over the stored (member ID, xp, last activity) of a copy of the table, so that the table can keep
+        changing while the records are consumed.
+        """
+        return chain(zip(self._ids[:], self._xp[:], self._seen[:]),
+                     [(uid, xp, seen) for uid, (xp, seen) in self._new.items()])
+
+    def _find(self, uid: int) -> int:
+        i = bisect_left(self._ids, uid)
+        return i if i < len(self._ids) and self._ids[i] == uid else -1
+
+    def _merge(self):
+        items = sorted(self._records())
+        self._ids = array('Q', (uid for uid, _ in items))
+        self._xp = array('q', (xp for _, (xp, _) in items))
+        self._seen = array('I', (seen for _, (_, seen) in items))
+        self._new = {}
+
+    def __contains__(self, uid: int):
+        return uid in self._new or self._find(uid) >= 0
+
+    def __len__(self):
+        return len(self._ids) + len(self._new)
+
+    def __getitem__(self, uid: int) -> int:
+        xp = self.get(uid)
+        if xp is None:
+            raise KeyError(uid)
+        return xp
+
+    def set_half_life(self, half_life: float) -> int:
+        """
+        :return: the amount of records stamped with the current time, which need saving
+        """
+        self._period = half_life * 86400
+        stamped = self._stamp_unknown()
+        self._rank = self._build_rank()
+        return stamped
+
+    def record(self, uid: int):
+        """
+        Returns the stored (xp, last activity) of the member, without decay applied, or None.
+        """
+        if uid in self._new:
+            return tuple(self._new[uid])
+        i = self._find(uid)
+        return (self._xp[i], self._seen[i]) if i >= 0 else None
+
+    def members(self) -> list:
+        return [*self._ids, *self._new]
+
+    def get(self, uid: int, default=None):
+        record = self.record(uid)
+        return self._decayed(*record, int(time())) if record else default
+
+    def add(self, uid: int, xp: int, now: int = None):
+        """
+        Adds (or with a negative value, takes) XP to the member, creating the record if necessary.
+        :param now: the time the XP was earned at, by default the current time
+        """
+        now = int(time()) if now is None else now
+        record = self.record(uid)
+        if record is not None and not xp:
+            return
+        if record and now < record[1]:
+            # XP earned before the last activity (recounted history, deleted messages) decays up to the record
+            new = record[0] + (round(xp * 2 ** ((now - record[1]) / self._period)) if self._period else xp)
+            now = record[1]
+        else:
+            new = (self._decayed(*record, now) if record else 0) + xp
+        if self._period:
+            new = max(new, 0)
+        if record is not None:
+            self._rank.remove(self._key(*record), uid)
+            if uid in self._new:
+                self._new[uid] = [new, now]
+            else:
+                i = self._find(uid)
+                self._xp[i] = new
+                self._seen[i] = now
+        else:
+            self._new[uid] = [new, now]
+            if len(self._new) > max(256, len(self._ids) >> 4):
+                self._merge()
+        self._rank.add(self._key(new, now), uid)
+
+    def pop(self, uid: int) -> int:
+        record = self.record(uid)
+        if record is None:
+            raise KeyError(uid)
+        if uid in self._new:
+            del self._new[uid]
+        else:
+            i = self._find(uid)
+            del self._ids[i]
+            del self._xp[i]
+            del self._seen[i]
+        self._rank.remove(self._key(*record), uid)
+        return self._decayed(*record, int(time()))
+
+    def rank(self, uid: int) -> int:
+        """
+        Returns the leaderboard position of the member, starting from 1.
+        """
+        record = self.record(uid)
+        if record is None:
+            raise KeyError(uid)
+        return self._rank.index(self._key(*record), uid) + 1
+
+    def top(self):
+        """
+        Iterates over (member ID, xp) pairs from highest XP to lowest.
+        """
+        if not self._period:
+            return ((uid, -key) for key, uid in self._rank)
+        now = time() / self._period
+        return ((uid, 0 if key == float('inf') else round(2 ** (-key - now))) for key, uid in self._rank)
+
+
+class XPLedger:
+    """
+    A bounded record of the XP awarded for each message, so deleting a message takes back exactly what it earned,
+    without needing the message content or the settings it was awarded under.
+    Entries are kept in a ring of parallel arrays, oldest first, and are evicted once the ring is full or once they
+    are older than max_age seconds.
+    """
+
+    def __init__(self, size: int, max_age: float):
+        self.size = max(size, 1)
+        self.max_age = max_age
+        self._mids = array('Q', bytes(8 * self.size))
+        self._gids = array('Q', bytes(8 * self.size))
+        self._uids = array('Q', bytes(8 * self.size))
+        self._xp = array('q', bytes(8 * self.size))
+        self._index = {}  # self._index[message ID]: slot
+        self._head = 0  # slot of the oldest entry
+        self._len = 0
+
+    def __len__(self):
+        return len(self._index)
+
+    def record(self, mid: int, gid: int, uid: int, xp: int):
+        if self._len == self.size:
+            self._evict()
+        slot = (self._head + self._len) % self.size
+        self._mids[slot] = mid
+        self._gids[slot] = gid
+        self._uids[slot] = uid
+        self._xp[slot] = xp
+        self._index[mid] = slot
+        self._len += 1
+
+    def pop(self, mid: int):
+        """
+        Removes the entry of a message, returning (guild ID, member ID, xp), or None if the message isn't recorded.
+        """
+        slot = self._index.pop(mid, None)
+        if slot is None:
+            return None
+        # leave a blank entry behind, it's cleared out once it becomes the oldest
+        self._mids[slot] = 0
+        return self._gids[slot], self._uids[slot], self._xp[slot]
+
+    def expire(self):
+        cutoff = time_snowflake(utcnow() - timedelta(seconds=self.max_age))
+        while self._len and self._mids[self._head] < cutoff:
+            self._evict()
+
+    def _evict(self):
+        self._index.pop(self._mids[self._head], None)
+        self._mids[self._head] = 0
+        self._head = (self._head + 1) % self.size
+        self._len -= 1
+
+
+class EvalProgress:
+    """
+    Keeps track of a running EvalXP scan, estimating how far along it is from the timestamps of the processed messages
+    (messages are scanned oldest first, so the position in time is a decent stand-in for the position in history).
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.channels = 0
+        self.channels_done = 0
+        self.start = time()
+        self._spans = {}  # channel id: [covered seconds, total seconds, start time]
+
+    def add_channel(self, channel, after: int = None, before: int = None):
+        self.channels += 1
+        begin = snowflake_time(after) if after else channel.created_at
+        end = snowflake_time(before) if before else utcnow()
+        self._spans[channel.id] = [0.0, max((end - begin).total_seconds(), 1.0), begin]
+
+    def advance(self, channel, message):
+        span = self._spans[channel.id]
+        span[0] = min((message.created_at - span[2]).total_seconds(), span[1])
+        self.count += 1
+
+    def finish_channel(self, channel):
+        span = self._spans[channel.id]
+        span[0] = span[1]
+        self.channels_done += 1
+
+    def text(self) -> str:
+        elapsed = max(time() - self.start, 0.001)
+        covered = sum(x[0] for x in self._spans.values())
+        total = sum(x[1] for x in self._spans.values()) or 1.0
+        fraction = covered / total
+        if fraction > 0:
+            eta = int(elapsed * (1 - fraction) / fraction)
+            eta = f"{eta // 3600}:{eta // 60 % 60:02d}:{eta % 60:02d}"
+        else:
+            eta = "unknown"
+        return f"**AFFIRMATIVE. Processing messages: {self.count} processed ({self.count / elapsed:.1f}/s), " \
+               f"{self.channels_done}/{self.channels} channels done, {fraction:.0%}, ETA {eta}.**"
+
+
+class Leaderboard:
+    # Class used to display an XP leaderboard that can be paged through with reactions, in the manner of the shop.
+    # Pages are rendered from the ranking when they're shown, so only the visible entries are ever formatted.
+
+    user: int  # User that called the leaderboard. No one else is allowed to flip pages.
+    page: int  # Current page
+    time: float  # time of last interaction, for timeout purposes.
+
+    _mpage: int  # total amount of pages
+    _parent: "Levelling"  # parent class.
+    _guild: object  # the guild the leaderboard belongs to
+    _ranking: callable  # returns an iterator over (member ID, xp) pairs, highest first
+    _skip: bool  # whether to leave out members that aren't in the guild anymore
+    _title: str
+    _message: Message  # message that the leaderboard is displayed in
+
+    _emoji = "◀🇽▶"
+
+    def __init__(self, parent: "Levelling", user: int, guild, ranking, total: int, title: str, skip: bool,
+                 length: int = 10):
+        self._parent = parent
+        self.user = user
+        self.time = time()
+        self.page = 0
+        self._guild = guild
+        self._ranking = ranking
+        self._skip = skip
+        self._title = title
+        self._len = length
+        self._mpage = max(total - 1, 0) // length
+
+    async def post(self, msg):
+        # Creates the leaderboard message and adds itself to the parent storage.
+        self._message = await respond(msg, self.text())
+        for emoji in self._emoji:
+            await self._message.add_reaction(emoji)
+        self._parent.leaderboards.setdefault(self._guild.id, {})[self._message.id] = self
+
+    def _entries(self):
+        # Not using enumerate because some positions may be skipped due to missing members.
+        pos = 0
+        for uid, xp in self._ranking():
+            name = self._parent._display_name(self._guild, uid)
+            if name is None:
+                if self._skip:
+                    continue
+                name = str(uid)
+            pos += 1
+            yield pos, name, xp
+
+    def text(self):
+        start = self.page * self._len
+        lines = [f"{pos:>5}|{name[:32]:<32}|{xp:>9}"
+                 for pos, name, xp in islice(self._entries(), start, start + self._len)]
+        p = f"[Page {self.page + 1} of {self._mpage + 1}]"
+        return f"```\n{self._title:^48}\n{'=' * 48}\n" + ("\n".join(lines) or "Nobody here yet.") + f"\n\n{p:^48}```"
+
+    async def react(self, reaction: Reaction):
+        if reaction.emoji == '🇽':
+            del self._parent.leaderboards[self._guild.id][self._message.id]
+            await self._message.delete()
+        elif reaction.emoji == '◀' and self.page > 0:
+            self.page -= 1
+            self.time = time()
+            await self._message.edit(content=self.text())
+        elif reaction.emoji == '▶' and self.page < self._mpage:
+            self.page += 1
+            self.time = time()
+            await self._message.edit(content=self.text())
 
 
 class Levelling(BasePlugin):
     name = "levelling"
-    version = "1.1"
+    version = "1.2"
     author = "GTG3000"
     description = "A plugin for providing an XP system that awards members XP for messages."
     default_config = {
+        "storage": "json",
+        "flush_interval": 60,
+        "flush_threshold": 1000,
+        "ledger_size": 100000,
+        "ledger_age": 60 * 60 * 24 * 7,
+        "eval_concurrency": 4,
+        "eval_update_interval": 10,
+        "leaderboard_delay": 120,
         "default": {
             "low_cutoff": 75,
             "xp_min": 1,
             "xp_max": 10,
+            "half_life": 0,
+            "level_xp": 100,
+            "cooldown": 0,
             "skip_missing": False
         }
     }
     channel_categories = {"no_xp"}
 
-    storage: JsonFileDict
+    storage: dict  # self.storage[gid]: XPTable, loaded lazily per guild
+    rules: dict  # self.rules[gid]: XPRules, compiled on first use
+    ledger: XPLedger  # XP awarded per message, to take back on deletion
+    # members whose level crossed a role reward threshold, so that role changes caused by bursts of messages or an
+    # EvalXP run are applied with one edit per member on the next tick
+    _role_queue: dict  # self._role_queue[gid]: set of member IDs
+    _cooldowns: dict  # self._cooldowns[gid][uid]: time of the last XP award, entries expire lazily
+    _evaluating: set  # guild IDs with an EvalXP run in progress
+
+    leaderboards: dict  # self.leaderboards[guild id][message id]: Leaderboard
+    _names: dict  # self._names[guild id][uid]: display name or None, dropped when the member changes
+    store: [JsonXPStore, SqliteXPStore]
+
+    # XP is awarded on every message, so instead of rewriting the XP file each time the tables are kept in memory and
+    # only the guilds that changed are written out, either on the tick or once enough changes pile up.
+    _dirty: dict  # self._dirty[gid]: set of member IDs (as ints) with unsaved changes
+    _reset: set  # guild IDs whose tables were replaced whole since the last flush
+    _pending: int  # amount of changes since the last flush
+    _last_flush: float
+    _flush_lock: asyncio.Lock
 
     async def activate(self):
-        self.storage = self.config_manager.get_plugin_config_file("xp.json")
+        # the last processed message ID per channel, so interrupted EvalXP runs can continue where they stopped, and
+        # under "cutoff" the ID of the command that started the scan, past which messages already got XP live
+        self.eval_checkpoints = self.config_manager.get_plugin_config_file("xp_eval_checkpoints.json")
+        self.storage = {}
+        self.rules = {}
+        self.ledger = XPLedger(self.plugin_config.get('ledger_size', 100000),
+                               self.plugin_config.get('ledger_age', 60 * 60 * 24 * 7))
+        self._role_queue = {}
+        self._cooldowns = {}
+        self._evaluating = set()
+        self.leaderboards = {}
+        self._names = {}
+        self._dirty = {}
+        self._reset = set()
+        self._pending = 0
+        self._last_flush = time()
+        self._flush_lock = asyncio.Lock()
+
+        json_folder = self.client.storage_dir / "xp"
+        if not json_folder.exists():
+            # the XP tables used to be kept in a single xp.json
+            legacy = self.config_manager.get_plugin_config_file("xp.json")
+            self.store = JsonXPStore(json_folder)
+            self._migrate((gid, table, None, None) for gid, table in legacy.items())
+        if self.plugin_config.get('storage', 'json') == "sqlite":
+            self.store = SqliteXPStore(self.client.storage_dir / "xp.sqlite")
+            if not self.store.migrated():
+                # databases from before the migration was recorded count as migrated if they have any records
+                if self.store.empty():
+                    json_store = JsonXPStore(json_folder)
+                    self._migrate((gid, *json_store.load(gid)) for gid in json_store.guilds())
+                self.store.mark_migrated()
+        else:
+            self.store = JsonXPStore(json_folder)
+
+    async def deactivate(self):
+        await self._flush()
+        self.store.close()
 
     async def on_message(self, msg):
-        if not self.channel_manager.channel_in_category(msg.guild, "no_xp", msg.channel):
-            self._give_xp(msg)
+        rules = self._rules(msg.guild)
+        if msg.channel.id not in rules.excluded:
+            if rules.cooldown:
+                now = time()
+                cooldowns = self._cooldowns.setdefault(msg.guild.id, {})
+                if now - cooldowns.get(msg.author.id, 0) < rules.cooldown:
+                    # still recorded, so deleting the message doesn't take back XP it never earned
+                    xp = 0
+                else:
+                    xp = self._give_xp(msg, rules)
+                    # only messages that actually earn XP start the cooldown
+                    if xp:
+                        cooldowns[msg.author.id] = now
+            else:
+                xp = self._give_xp(msg, rules)
+            self.ledger.record(msg.id, msg.guild.id, msg.author.id, xp)
+            if self._pending >= self.plugin_config.get('flush_threshold', 1000) and not self._flush_lock.locked():
+                await self._flush()
 
-    async def on_message_delete(self, msg):
-        if not self.channel_manager.channel_in_category(msg.guild, "no_xp", msg.channel):
-            self._take_xp(msg)
+    async def on_raw_message_delete(self, payload):
+        self._take_xp(payload.message_id, payload.cached_message)
+
+    async def on_raw_bulk_message_delete(self, payload):
+        cached = {msg.id: msg for msg in payload.cached_messages}
+        for mid in payload.message_ids:
+            self._take_xp(mid, cached.get(mid))
 
     # Commands
 
     @Command("ListXP", "XPLeaderboard",
-             doc="Lists all registered users from highest XP to lowest, up to amount specified or 10.",
-             syntax="[number]",
+             doc="Shows a leaderboard of all registered users from highest XP to lowest, that can be paged through "
+                 "with reactions, showing the amount of users specified per page, or 10.\n"
+                 "Use -w/--week or -m/--month to rank by XP gained over the last seven days or the last five "
+                 "calendar weeks instead.",
+             syntax="[-w/--week] [-m/--month] [number]",
              category="levelling")
     async def _listxp(self, msg):
         gid = str(msg.guild.id)
 
-        xp_dict = self.storage.setdefault(gid, dict())
-        skip = self.plugin_config.setdefault(gid, self.plugin_config['default'].copy())['skip_missing']
+        xp_dict = self._table(gid)
+        skip = self._guild_config(gid)['skip_missing']
 
-        args = msg.content.split()
-        if len(args) > 1:
+        args = msg.content.split()[1:]
+        period = None
+        if args and args[0].lower() in ("-w", "--week", "-m", "--month"):
+            period = "monthly" if args.pop(0).lower() in ("-m", "--month") else "weekly"
+        if args:
             try:
-                limit = int(args[1])
+                limit = min(max(int(args[0]), 1), 30)
             except ValueError:
-                raise CommandSyntaxError(f"{args[1]} is not a valid integer.")
+                raise CommandSyntaxError(f"{args[0]} is not a valid integer.")
         else:
             limit = 10
 
-        # Iterate over all the xp values, counting up the position and forming a nice string.
-        # Not using enumerate because some positions may be skipped due to missing members.
-        # Could possibly squeeze it into a list comprehension, but it would be a monstrosity.
-
-        pos = 1
-        xp_list = []
-        for uid in sorted(xp_dict, key=xp_dict.get, reverse=True):
-            user = msg.guild.get_member(int(uid))
-
-            if user:
-                user = user.display_name
-            elif skip:
-                continue
-            else:
-                user = uid
-
-            xp_list.append(f"{pos:03d}|{user:<32}|{xp_dict[uid]:>6}")
-            pos += 1
+        if period:
+            # the period totals only cover recently active members, so they're cheap to take a snapshot of
+            ranking = xp_dict.periods.top(monthly=period == "monthly")
+            total = self._shown(msg.guild, (uid for uid, _ in ranking)) if skip else len(ranking)
+            leaderboard = Leaderboard(self, msg.author.id, msg.guild, lambda: iter(ranking), total,
+                                      f"{period.capitalize()} XP Leaderboard", skip, limit)
+        else:
+            total = self._shown(msg.guild, xp_dict.members()) if skip else len(xp_dict)
+            leaderboard = Leaderboard(self, msg.author.id, msg.guild, xp_dict.top, total, "XP Leaderboard", skip,
+                                      limit)
 
-            if pos > limit:
-                break
+        boards = self.leaderboards.setdefault(msg.guild.id, {})
+        for mid in [k for k, v in boards.items() if v.user == msg.author.id]:
+            try:
+                await boards.pop(mid)._message.delete()
+            except (NotFound, Forbidden):
+                pass
 
-        if xp_list:
-            for string in group_items(xp_list, message="**ANALYSIS: Current XP leaderboard:**"):
-                await respond(msg, string)
+        await leaderboard.post(msg)
 
     @Command("XP", "ShowXP",
              doc="Shows your xp or xp of specified user.",
@@ -89,54 +1073,95 @@ class Levelling(BasePlugin):
 
         args = msg.content.split(None, 1)
 
-        xp_dict = self.storage.setdefault(gid, dict())
+        xp_dict = self._table(gid)
+        rules = self._rules(msg.guild)
 
         if len(args) > 1:
             user = find_user(msg.guild, args[1])
             if user:
-                if str(user.id) in xp_dict:
-                    await respond(msg, f"**ANALYSIS: User {user.display_name} has "
-                                       f"{xp_dict[str(user.id)]} XP.**")
+                if user.id in xp_dict:
+                    xp = xp_dict[user.id]
+                    await respond(msg, f"**ANALYSIS: User {user.display_name} has {xp} XP, level {rules.level(xp)}, "
+                                       f"rank #{xp_dict.rank(user.id)} of {len(xp_dict)}.**")
                 else:
                     await respond(msg, f"**WARNING: User {user.display_name} has no XP record.**")
             else:
                 raise CommandSyntaxError("Not a user or user not found.")
         else:
-            uid = str(msg.author.id)
+            uid = msg.author.id
             if uid in xp_dict:
-                await respond(msg, f"**ANALYSIS: You have {xp_dict[uid]} XP.**")
+                xp = xp_dict[uid]
+                await respond(msg, f"**ANALYSIS: You have {xp} XP, level {rules.level(xp)}, "
+                                   f"rank #{xp_dict.rank(uid)} of {len(xp_dict)}.**")
             else:
                 await respond(msg, "**ANALYSIS: You have no XP record.**")  # I don't think this is possible
 
     @Command("EvalXP",
-             doc="Processes all message history and grants members xp.\nAccepts one argument to determine "
-                 "how far into the history to search.\nWARNING - VERY SLOW.\nUSE ONLY AFTER "
+             doc="Processes message history and grants members xp.\nAccepts one argument to limit how many messages "
+                 "are processed per channel in one run.\nChannels are scanned in parallel, and the position in each "
+                 "channel is saved, so running the command again continues where the last run stopped. Only "
+                 "messages from before the first run are counted, later ones having earned XP when they were "
+                 "posted.\n"
+                 "Use -r/--reset to forget the saved positions and start from the beginning.\nUSE ONLY AFTER "
                  "CLEANING XP TABLE.",
-             syntax="[depth]",
+             syntax="[-r/--reset] [depth]",
              perms={"manage_guild"},
              category="levelling")
     async def _evalxp(self, msg):
-        args = msg.content.split(None, 1)
-        if len(args) > 1:
+        gid = str(msg.guild.id)
+        if gid in self._evaluating:
+            # both runs would continue from the same checkpoints, counting the same messages twice
+            await respond(msg, "**NEGATIVE. XP evaluation is already in progress on this server.**")
+            return
+        args = msg.content.split()[1:]
+        if args and args[0].lower() in ("-r", "--reset"):
+            self.eval_checkpoints[gid] = {}
+            args = args[1:]
+        if args:
             try:
-                depth = int(args[1])
+                depth = int(args[0])
             except ValueError:
                 raise CommandSyntaxError("Argument is not a valid integer.")
         else:
             depth = None
 
-        display = await respond(msg, "**AFFIRMATIVE. Processing messages.**")
-        async with msg.channel.typing():
-            for channel in msg.guild.text_channels:
-                if not self.channel_manager.channel_in_category(msg.guild, "no_xp", channel):
-                    await display.edit(content=f"**AFFIRMATIVE. Processing messages in channel {channel}.**")
+        checkpoints = self.eval_checkpoints.setdefault(gid, {})
+        cutoff = checkpoints.setdefault("cutoff", msg.id)
+        rules = self._rules(msg.guild)
+        channels = [c for c in msg.guild.text_channels if c.id not in rules.excluded]
+        progress = EvalProgress()
+        for channel in channels:
+            progress.add_channel(channel, checkpoints.get(str(channel.id)), cutoff)
+
+        semaphore = asyncio.Semaphore(max(self.plugin_config.get('eval_concurrency', 4), 1))
+        self._evaluating.add(gid)
+        tasks = []
+        try:
+            display = await respond(msg, progress.text())
+            async with msg.channel.typing():
+                tasks = [asyncio.ensure_future(self._eval_channel(channel, depth, checkpoints, cutoff, progress,
+                                                                  semaphore, rules))
+                         for channel in channels]
+                scan = asyncio.gather(*tasks)
+                while True:
                     try:
-                        async for message in channel.history(limit=depth):
-                            self._give_xp(message)
-                    except Forbidden:
-                        continue
+                        await asyncio.wait_for(asyncio.shield(scan),
+                                               timeout=self.plugin_config.get('eval_update_interval', 10))
+                        break
+                    except asyncio.TimeoutError:
+                        # save XP before the checkpoints, so a crash can only cause messages to be counted twice
+                        await self._flush()
+                        self.eval_checkpoints.save()
+                        await display.edit(content=progress.text())
+        finally:
+            # if a channel failed, the others are stopped too, so that nothing is counted past the saved checkpoints
+            for task in tasks:
+                task.cancel()
+            self._evaluating.discard(gid)
+            await self._flush()
+            self.eval_checkpoints.save()
 
-        self.storage.save()
+        await self._apply_roles()
         await display.delete()
 
     @Command("NukeXP",
@@ -150,24 +1175,83 @@ class Levelling(BasePlugin):
 
         if len(args) > 1:
             user = find_user(msg.guild, args[1])
-            xp_dict = self.storage.setdefault(gid, dict())
+            xp_dict = self._table(gid)
             if user:
-                if str(user.id) in xp_dict:
-                    del xp_dict[str(user.id)]
+                if user.id in xp_dict:
+                    xp_dict.pop(user.id)
+                    xp_dict.periods.pop(user.id)
+                    self._mark_dirty(gid, user.id)
                     await respond(msg, f"**AFFIRMATIVE. User {user.display_name} was removed from XP table.**")
                 else:
                     await respond(msg, f"**NEGATIVE. User {user.display_name} has no XP record.**")
-            elif args[1] in xp_dict:
-                del xp_dict[args[1]]
+            elif args[1].isdecimal() and int(args[1]) in xp_dict:
+                xp_dict.pop(int(args[1]))
+                xp_dict.periods.pop(int(args[1]))
+                self._mark_dirty(gid, int(args[1]))
                 await respond(msg, f"**AFFIRMATIVE. ID {args[1]} was removed from XP table.**")
             else:
                 raise CommandSyntaxError("Not a user or no user found.")
         else:
-            self.storage[gid] = {}
+            self.storage[gid] = XPTable(half_life=self._guild_config(gid).get('half_life', 0))
+            self._mark_dirty(gid)
+            self.eval_checkpoints[gid] = {}
+            self.eval_checkpoints.save()
             await respond(msg, "**AFFIRMATIVE. XP table deleted.**")
 
+    @Command("ExportXP",
+             doc="Exports the XP table as a CSV or JSONL file of member IDs, XP and last activity times.",
+             syntax="[csv/jsonl]",
+             perms={"manage_guild"},
+             category="levelling")
+    async def _exportxp(self, msg):
+        gid = str(msg.guild.id)
+        args = msg.content.split()
+        fmt = args[1].lower() if len(args) > 1 else "csv"
+        if fmt not in ("csv", "jsonl"):
+            raise CommandSyntaxError("Format must be csv or jsonl.")
+
+        records = self._table(gid).records()
+        async with msg.channel.typing():
+            fp = await asyncio.get_running_loop().run_in_executor(None, export_xp, records, fmt)
+            with fp:
+                await respond(msg, "**AFFIRMATIVE. XP table exported.**", file=File(fp, filename=f"xp_{gid}.{fmt}"))
+
+    @Command("ImportXP",
+             doc="Replaces the XP table with the one in the attached CSV or JSONL file, in the format ExportXP "
+                 "produces.\nWARNING - THE CURRENT TABLE IS DISCARDED.",
+             syntax="(attached file)",
+             perms={"manage_guild"},
+             category="levelling")
+    async def _importxp(self, msg):
+        gid = str(msg.guild.id)
+        if not msg.attachments:
+            raise CommandSyntaxError("An attached CSV or JSONL file is required.")
+        attachment = msg.attachments[0]
+        fmt = "jsonl" if attachment.filename.lower().endswith((".jsonl", ".json")) else "csv"
+        half_life = self._guild_config(gid).get('half_life', 0)
+
+        with TemporaryFile() as _file:
+            await attachment.save(_file)
+            async with msg.channel.typing():
+                try:
+                    table = await asyncio.get_running_loop().run_in_executor(
+                        None, lambda: XPTable.from_records(import_xp(_file, fmt), half_life))
+                except ValueError as e:
+                    raise CommandSyntaxError(e)
+
+        # the new table is only swapped in once it's complete, keeping the weekly/monthly buckets of the old one
+        table.periods = self._table(gid).periods
+        self.storage[gid] = table
+        self._mark_dirty(gid)
+        await respond(msg, f"**AFFIRMATIVE. Imported XP records of {len(table)} members.**")
+
     @Command("XPConfig", "XPSettings",
-             doc="Edit the xp module settings, or see the current settings."
+             doc="Edit the xp module settings, or see the current settings.\n"
+                 "Options are low_cutoff, xp_min, xp_max, missing, half_life, which makes XP of inactive members "
+                 "halve every given amount of days (0 to disable), cooldown, the seconds a member has to wait "
+                 "after earning XP to earn it again, level_xp, the XP the first level costs (each "
+                 "level after costs that much more than the one before), and multiplier, which takes a channel and a "
+                 "number to multiply the XP gained in it by."
                  "\nIt is advised to do !nukexp !evalxp after adjusting settings.",
              syntax="[option] [value]",
              perms={"manage_guild"},
@@ -175,17 +1259,38 @@ class Levelling(BasePlugin):
     async def _setxp(self, msg):
         gid = str(msg.guild.id)
         args = msg.content.split(" ", 2)
-        cfg = self.plugin_config.setdefault(gid, self.plugin_config['default'].copy())
+        cfg = self._guild_config(gid)
         if len(args) == 1:
             missing_member_str = ("skipping" if cfg["skip_missing"] else "displaying") + " missing members"
+            multipliers = "".join(f"\n  {msg.guild.get_channel(int(cid)) or cid}: ×{mult}"
+                                  for cid, mult in cfg.get("multipliers", {}).items())
             await respond(msg, "**ANALYSIS: Current XP settings:**```\n"
                                f"low_cutoff: {cfg['low_cutoff']}\n"
                                f"xp_min    : {cfg['xp_min']}\n"
                                f"xp_max    : {cfg['xp_max']}\n"
-                               f"missing   : {missing_member_str}```")
+                               f"half_life : {cfg.get('half_life', 0) or 'no decay'}\n"
+                               f"level_xp  : {cfg.get('level_xp', 100)}\n"
+                               f"cooldown  : {cfg.get('cooldown', 0)} seconds\n"
+                               f"missing   : {missing_member_str}\n"
+                               f"multiplier: {multipliers or 'none'}```")
         elif len(args) == 3:
             if args[1].lower() == "missing":
                 cfg["skip_missing"] = is_positive(args[2])
+            elif args[1].lower() == "multiplier":
+                try:
+                    channel, val = args[2].rsplit(None, 1)
+                    channel = msg.guild.get_channel(int(channel.strip("<#>")))
+                    val = float(val)
+                except ValueError:
+                    raise CommandSyntaxError("Multiplier requires a channel and a number.")
+                if not channel:
+                    raise CommandSyntaxError("Channel not found.")
+                if not (isfinite(val) and val >= 0):
+                    raise CommandSyntaxError("Multiplier must be a finite number, 0 or above.")
+                if val == 1:
+                    cfg.setdefault("multipliers", {}).pop(str(channel.id), None)
+                else:
+                    cfg.setdefault("multipliers", {})[str(channel.id)] = val
             else:
                 try:
                     val = int(args[2])
@@ -198,40 +1303,282 @@ class Levelling(BasePlugin):
                         cfg["xp_min"] = val
                     elif args[1].lower() == "xp_max":
                         cfg["xp_max"] = val
+                    elif args[1].lower() == "cooldown":
+                        cfg["cooldown"] = max(val, 0)
+                    elif args[1].lower() == "level_xp":
+                        cfg["level_xp"] = max(val, 1)
+                    elif args[1].lower() == "half_life":
+                        cfg["half_life"] = max(val, 0)
+                        if gid in self.storage and self.storage[gid].set_half_life(cfg["half_life"]):
+                            self._mark_dirty(gid)
                     else:
                         raise CommandSyntaxError(f"No option {args[1].lower()}")
+            self.rules.pop(gid, None)
         else:
             raise CommandSyntaxError("Two arguments required.")
 
-    # Utilities
-
-    def _give_xp(self, msg):
+    @Command("XPRole", "LevelRole",
+             doc="Sets a role to be given to members once they reach the given level, or with no role given, removes "
+                 "the reward of that level.\nCalling it without any arguments lists the role rewards.\n"
+                 "Members keep the rewards of lower levels as well.",
+             syntax="[level] [role]",
+             perms={"manage_roles"},
+             category="levelling")
+    async def _xprole(self, msg):
         gid = str(msg.guild.id)
-        uid = str(msg.author.id)
-        if uid in self.storage.setdefault(gid, dict()):
-            self.storage[gid][uid] += self._calc_xp(msg.clean_content, gid)
+        args = msg.content.split(None, 2)
+        rewards = self._guild_config(gid).setdefault("level_roles", {})
+        if len(args) == 1:
+            reward_list = [f"{int(level):>4} | {msg.guild.get_role(role) or role}"
+                           for level, role in sorted(rewards.items(), key=lambda x: int(x[0]))]
+            if reward_list:
+                for string in group_items(reward_list, message="**ANALYSIS: Current level role rewards:**"):
+                    await respond(msg, string)
+            else:
+                await respond(msg, "**ANALYSIS: No level role rewards set.**")
+            return
+        try:
+            level = int(args[1])
+        except ValueError:
+            raise CommandSyntaxError(f"{args[1]} is not a valid integer.")
+        if len(args) == 2:
+            if rewards.pop(str(level), None) is None:
+                raise CommandSyntaxError(f"No role reward for level {level}.")
+            await respond(msg, f"**AFFIRMATIVE. Removed role reward for level {level}.**")
         else:
-            self.storage[gid][uid] = self._calc_xp(msg.clean_content, gid)
+            role = find_role(msg.guild, args[2])
+            if not role:
+                raise CommandSyntaxError(f"Unable to find role {args[2]}.")
+            rewards[str(level)] = role.id
+            await respond(msg, f"**AFFIRMATIVE. Role {role.name} will be given at level {level}.**")
+        self.rules.pop(gid, None)
 
-    def _take_xp(self, msg):
-        gid = str(msg.guild.id)
-        uid = str(msg.author.id)
-        if uid in self.storage.setdefault(gid, dict()):
-            self.storage[gid][uid] -= self._calc_xp(msg.clean_content, gid)
+    # Events
+
+    async def on_reaction_add(self, reaction, user):
+        gid = reaction.message.guild.id
+        mid = reaction.message.id
+
+        if gid in self.leaderboards \
+                and mid in self.leaderboards[gid] \
+                and isinstance(reaction.emoji, str) \
+                and reaction.emoji in Leaderboard._emoji \
+                and self.leaderboards[gid][mid].user == user.id:
+            await self.leaderboards[gid][mid].react(reaction)
+            if user.id != self.client.user.id:
+                try:
+                    await reaction.message.remove_reaction(reaction.emoji, user)
+                except (Forbidden, NotFound):
+                    pass
+
+    async def on_member_update(self, before, after):
+        self._names.get(after.guild.id, {}).pop(after.id, None)
+
+    async def on_member_join(self, member):
+        self._names.get(member.guild.id, {}).pop(member.id, None)
+
+    async def on_member_remove(self, member):
+        self._names.get(member.guild.id, {}).pop(member.id, None)
+
+    async def on_global_tick(self, *_):
+        for boards in self.leaderboards.values():
+            for mid in [k for k, v in boards.items()
+                        if time() - v.time > self.plugin_config.get('leaderboard_delay', 120)]:
+                try:
+                    await boards.pop(mid)._message.delete()
+                except NotFound:
+                    pass
+        if self._role_queue:
+            await self._apply_roles()
+        if time() - self._last_flush >= self.plugin_config.get('flush_interval', 60):
+            # channel categories can be changed by other plugins without notice, so the compiled rules are
+            # periodically dropped to pick up changes to the no_xp category.
+            self.rules.clear()
+            self.ledger.expire()
+            self._expire_cooldowns()
+            await self._flush()
+
+    # Storage
 
-    def _calc_xp(self, txt, gid):
+    def _table(self, gid: str) -> XPTable:
         """
-        :type txt:str
-        :param txt:message to calculate the xp for
-        :return:
+        Returns the XP table of the guild, loading it from storage on first access.
         """
-        spc = self.plugin_config.setdefault(gid, self.plugin_config['default'].copy())
+        try:
+            return self.storage[gid]
+        except KeyError:
+            try:
+                table, seen, periods = self.store.load(gid)
+            except (ValueError, sqlite3.Error):
+                self.logger.exception(f"XP table for guild {gid} couldn't be loaded! Starting with an empty table.",
+                                      exc_info=True)
+                table, seen, periods = {}, {}, {}
+            table = self.storage[gid] = XPTable(table, seen, self._guild_config(gid).get('half_life', 0), periods)
+            if table.stamped:
+                self._mark_dirty(gid)
+            return table
 
-        if len(txt) < spc["low_cutoff"]:
-            return 0
+    def _mark_dirty(self, gid: str, uid: int = None):
+        """
+        Marks a member record as changed, or with no member given, the entire table as replaced.
+        """
+        if uid is None:
+            self._reset.add(gid)
+        self._dirty.setdefault(gid, set()).add(uid)
+        self._pending += 1
+
+    async def _flush(self):
+        """
+        Writes out the changes of all guilds since the last flush. Disk IO happens in a worker thread so that large
+        tables don't stall the event loop.
+        """
+        async with self._flush_lock:
+            dirty, self._dirty = self._dirty, {}
+            reset, self._reset = self._reset, set()
+            self._pending = 0
+            self._last_flush = time()
+            loop = asyncio.get_running_loop()
+            for gid, members in dirty.items():
+                # snapshot on the loop so the worker thread never sees the table change under it
+                self.storage[gid].periods.prune()
+                snapshot = self.store.snapshot(self.storage[gid], members, gid in reset)
+                try:
+                    await loop.run_in_executor(None, self.store.write, gid, snapshot)
+                except (OSError, sqlite3.Error):
+                    self.logger.exception(f"Could not save XP table for guild {gid}!", exc_info=True)
+                    self._dirty.setdefault(gid, set()).update(members)
+                    if gid in reset:
+                        self._reset.add(gid)
+
+    async def _eval_channel(self, channel, depth: int, checkpoints: dict, cutoff: int, progress: EvalProgress,
+                            semaphore: asyncio.Semaphore, rules: XPRules):
+        """
+        Grants XP for the history of one channel, oldest messages first, starting after the saved checkpoint and
+        stopping at the cutoff.
+        """
+        cid = str(channel.id)
+        async with semaphore:
+            after = checkpoints.get(cid)
+            try:
+                async for message in channel.history(limit=depth, after=Object(after) if after else None,
+                                                     before=Object(cutoff), oldest_first=True):
+                    self._give_xp(message, rules)
+                    checkpoints[cid] = message.id
+                    progress.advance(channel, message)
+            except Forbidden:
+                pass
+            progress.finish_channel(channel)
+
+    def _migrate(self, tables):
+        """
+        Copies XP tables from an older storage into the current one.
+        :param tables: iterable of (guild ID, {member ID: xp}, {member ID: last activity}, {member ID: buckets})
+        """
+        count = 0
+        for gid, table, seen, periods in tables:
+            self.store.write(gid, self.store.snapshot(XPTable(table, seen, periods=periods), set(), True))
+            count += 1
+        if count:
+            self.logger.info(f"Migrated XP tables of {count} guilds to {self.plugin_config.get('storage', 'json')} "
+                             f"storage.")
+
+    # Utilities
+
+    def _guild_config(self, gid: str) -> dict:
+        return self.plugin_config.setdefault(gid, deepcopy(self.plugin_config['default']))
+
+    def _display_name(self, guild, uid: int):
+        names = self._names.setdefault(guild.id, {})
+        try:
+            return names[uid]
+        except KeyError:
+            member = guild.get_member(uid)
+            name = names[uid] = member.display_name if member else None
+            return name
+
+    @staticmethod
+    def _shown(guild, members) -> int:
+        """
+        Returns the amount of the given members still in the guild, which is how many a leaderboard that skips
+        missing members shows.
+        """
+        return sum(1 for uid in members if guild.get_member(uid))
+
+    def _rules(self, guild) -> XPRules:
+        gid = str(guild.id)
+        try:
+            return self.rules[gid]
+        except KeyError:
+            excluded = (c.id for c in guild.text_channels
+                        if self.channel_manager.channel_in_category(guild, "no_xp", c))
+            rules = self.rules[gid] = XPRules(self._guild_config(gid), excluded)
+            return rules
+
+    def _give_xp(self, msg, rules: XPRules) -> int:
+        xp = rules.xp(msg.channel.id, len(msg.clean_content))
+        self._change_xp(str(msg.guild.id), msg.author.id, xp, msg.created_at.timestamp(), rules)
+        return xp
 
-        t_percent = (len(txt)-spc["low_cutoff"])/(2000-spc["low_cutoff"])
+    def _take_xp(self, mid: int, msg=None):
+        """
+        Takes back the XP awarded for a deleted message. Messages that aren't in the ledger (older ones, or ones from
+        before a restart) are recalculated from their content, if it's still cached.
+        """
+        entry = self.ledger.pop(mid)
+        if entry:
+            gid, uid, xp = entry
+            guild = self.client.get_guild(gid)
+            rules = self._rules(guild) if guild else None
+        elif msg and msg.guild:
+            rules = self._rules(msg.guild)
+            if msg.channel.id in rules.excluded:
+                return
+            gid, uid, xp = msg.guild.id, msg.author.id, rules.xp(msg.channel.id, len(msg.clean_content))
+        else:
+            return
+        if xp and uid in self._table(str(gid)):
+            self._change_xp(str(gid), uid, -xp, snowflake_time(mid).timestamp(), rules)
+
+    def _change_xp(self, gid: str, uid: int, xp: int, when: float, rules: XPRules = None):
+        table = self._table(gid)
+        rewards = rules and rules.reward_roles
+        if rewards:
+            tier = rules.reward_tier(table.get(uid, 0))
+        table.add(uid, xp, int(when))
+        table.periods.add(uid, xp, when)
+        self._mark_dirty(gid, uid)
+        if rewards and rules.reward_tier(table[uid]) != tier:
+            self._role_queue.setdefault(gid, set()).add(uid)
 
-        t_xp = spc["xp_min"] + (spc["xp_max"]-spc["xp_min"])*t_percent
+    def _expire_cooldowns(self):
+        now = time()
+        for gid, cooldowns in self._cooldowns.items():
+            cooldown = self._guild_config(str(gid)).get('cooldown', 0)
+            self._cooldowns[gid] = {uid: last for uid, last in cooldowns.items() if now - last < cooldown}
 
-        return int(t_xp)
+    async def _apply_roles(self):
+        """
+        Brings the reward roles of every queued member in line with their level, in a single edit per member.
+        """
+        queue, self._role_queue = self._role_queue, {}
+        for gid, members in queue.items():
+            guild = self.client.get_guild(int(gid))
+            if not guild:
+                continue
+            rules = self._rules(guild)
+            table = self._table(gid)
+            reward_roles = set(rules.reward_roles)
+            for uid in members:
+                member = guild.get_member(uid)
+                if not member:
+                    continue
+                earned = set(rules.reward_roles[:rules.reward_tier(table.get(uid, 0))])
+                current = {role.id for role in member.roles if role != guild.default_role}
+                target = (current - reward_roles) | earned
+                if target == current:
+                    continue
+                roles = [role for role in map(guild.get_role, target) if role]
+                try:
+                    await member.edit(roles=roles, reason="Updated level role rewards.")
+                except HTTPException:
+                    self.logger.warning(f"Unable to update level roles of {member} in {guild}.")